@@ -1,68 +1,46 @@
 from glue.config import data_factory
 from glue.core import Data
-import re
+import numpy as np
+import mmap
+import os
+import sys
 
-def is_newick(filename, **kwargs):
-    return filename.endswith('.nwk')
+# the Newick parser is shared with the tree viewer in viewer_test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer_test'))
 
-def parse(newick):
-    tokens = re.findall(r"([^:;,()\s]*)(?:\s*:\s*([\d.]+)\s*)?([,);])|(\S)", newick+";")
+from newick_parser import index_newick, newick_arrays
 
-    def recurse(nextid = 0, parentid = -1): # one node
-        thisid = nextid;
-        children = []
-        name, length, delim, ch = tokens.pop(0)
-        if ch == "(":
-            while ch in "(,":
-                node, ch, nextid = recurse(nextid+1, thisid)
-                children.append(node)
-            name, length, delim, ch = tokens.pop(0)
 
-        return {"id": thisid, "name": name, "length": float(length) if length else None,
-                "parentid": parentid, "children": children}, delim, nextid
+def is_newick(filename, **kwargs):
+    return filename.endswith('.nwk')
 
-    return recurse()[0]
 
-# names = []
-# size = []
-# parent = []
+@data_factory('Newick data loader', is_newick, priority=10000)
+def read_newick(file_name):
 
-# def clear_arrays(names, size, parent):
-#     names.clear()
-#     size.clear()
-#     parent.clear()
-#     return names, size, parent
+    # Every tree of the file is found in one scan, and parsed from the
+    # memory-mapped file (see viewer_test/newick_parser.py).
+    trees = index_newick(file_name)
 
-def extract_arrays(tree_structure, names, parent, size):
-    names.append(tree_structure['name'])
-    parent.append(tree_structure['parentid'])
-    size.append(tree_structure['length'])
-    if tree_structure['children']:
-        for sub_dicts in tree_structure['children']:
-            extract_arrays(sub_dicts, names, parent, size)
+    with open(file_name, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-@data_factory('Newick data loader', is_newick, priority=10000)
-def read_newick(file_name):
+    datasets = []
 
-    with open(file_name, 'r') as f:
-        newick_tree = f.readline()
+    for itree, (start, end, nnodes) in enumerate(trees):
 
-    # Open and parse newick file
-    # convert newick file into parent array
-    names = []
-    size = []
-    parent = []
+        buf = np.frombuffer(mapped, dtype=np.uint8)[start:end]
+        arrays = newick_arrays(buf)
 
-    newick_in = parse(newick_tree)
-    # names, size, parent = clear_arrays(names, size, parent)
-    extract_arrays(newick_in, names, parent, size)
+        if len(trees) == 1:
+            data = Data(label='newick file')
+        else:
+            data = Data(label='newick file [tree {0}]'.format(itree))
 
-    if (size[0] == None):
-        size[0] = 0
+        data['parent'] = arrays['parent']
+        data['names'] = list(arrays['names'].decode())
+        data['size'] = arrays['size']
 
-    data = Data(label='newick file')
-    data['parent'] = parent
-    data['names'] = names
-    data['size'] = size
+        datasets.append(data)
 
-    return data
+    return datasets[0] if len(datasets) == 1 else datasets
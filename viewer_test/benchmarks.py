@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy as np
+
+# headless: nothing below may need a display
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.cm as cm
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from dendro_helpers import (compute_heights, sort1Darrays, dendro_layout,
+                            preorder_permutation, orient_verts, SelectionGeometry)
+from layout_cache import TreeTopology, SortedTree, TreeLayout
+from newick_parser import parse
+
+'''
+Notes.
+* Benchmarks of the layout and selection pipeline of the tree viewer, run
+  from this directory:
+
+      python benchmarks.py --sizes 1000 10000 --output results.json
+
+  Every step is timed on synthetic balanced, caterpillar and random trees
+  and on the sample files under `data/`, and the best of `--repeat` runs
+  is reported with its throughput (structures per second). The JSON
+  output records the versions, so that the numbers of two releases can
+  be compared.
+* The astrodendro reader lives in config.py, which needs glue; without
+  glue reading the astrodendro files is reported as skipped.
+* The `apply_roi` steps time the selection of every ROI type (for the
+  bottom-up and the sideways orientations, which swap the ROI axes) and
+  the conversion to data ids, which is what the viewer method runs
+  besides creating the subset state.
+* The segments drawn in zoomed-in views of every tree are also checked
+  against a brute-force test of all the segments (see check_segments).
+'''
+
+try:
+    from config import DendroFile
+except ImportError as exc:
+    DendroFile = None
+    CONFIG_ERROR = str(exc)
+else:
+    CONFIG_ERROR = None
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
+SHAPES = ['balanced', 'caterpillar', 'random']
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+# the width of the viewer, for the level of detail of the drawn segments
+PIXELS = 1000
+
+
+def balanced_tree(n, rng):
+    '''
+    A complete binary tree of `n` structures.
+    '''
+
+    # the heap numbering is breadth-first, so it is put in preorder
+    parent = (np.arange(n) - 1) // 2
+    parent[0] = -1
+    _, _, parent = preorder_permutation(parent)
+
+    return parent, rng.random(n)
+
+
+def caterpillar_tree(n, rng):
+    '''
+    A binary tree of depth n / 2: every branch has a leaf and the next
+    branch as its children.
+    '''
+
+    # the branches are at the even ids, each followed by its leaf
+    parent = 2 * ((np.arange(n) - 1) // 2)
+    parent[0] = -1
+
+    return parent, rng.random(n)
+
+
+def random_tree(n, rng):
+    '''
+    A random recursive tree: every structure is attached to one of the
+    structures before it.
+    '''
+
+    parent = (rng.random(n) * np.arange(n)).astype(int)
+    parent[0] = -1
+    _, _, parent = preorder_permutation(parent)
+
+    return parent, rng.random(n)
+
+
+TREES = {'balanced': balanced_tree,
+         'caterpillar': caterpillar_tree,
+         'random': random_tree}
+
+
+def to_newick(parent, length):
+    '''
+    Writes a preorder parent array as a Newick string.
+    '''
+
+    tokens = []
+    # the branches whose children are being written
+    stack = []
+
+    for idx, par in enumerate(parent.tolist()):
+
+        while stack and stack[-1] != par:
+            branch = stack.pop()
+            tokens.append(')s{0}:{1:.6f}'.format(branch, length[branch]))
+
+        # the first child comes right after its parent in preorder
+        if par >= 0 and idx != par + 1:
+            tokens.append(',')
+
+        if idx + 1 < len(parent) and parent[idx + 1] == idx:
+            tokens.append('(')
+            stack.append(idx)
+        else:
+            tokens.append('s{0}:{1:.6f}'.format(idx, length[idx]))
+
+    while stack:
+        branch = stack.pop()
+        tokens.append(')s{0}:{1:.6f}'.format(branch, length[branch]))
+
+    tokens.append(';')
+
+    return ''.join(tokens)
+
+
+def read_csv_tree(file_name):
+    '''
+    The parent and height columns of a CSV tree.
+    '''
+
+    table = np.genfromtxt(file_name, delimiter=',', names=True)
+    parent = table['parent'].astype(int)
+    height = table['height'].astype(float)
+
+    return parent, height
+
+
+def timeit(func, repeat):
+    '''
+    The best time of `repeat` calls of `func`, and the result of the last.
+    '''
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def draw(canvas, collection, layout, orientation):
+    # the segments drawn at the level of detail of a full view
+    max_leaves = layout.nleaf / float(PIXELS)
+    if max_leaves > 1.:
+        verts = layout.segments(max_leaves=max_leaves)[1]
+    else:
+        verts = layout.verts
+
+    collection.set_segments(orient_verts(verts, orientation))
+    canvas.draw()
+
+
+def check_segments(layout, rng, nwindows=10):
+    '''
+    Checks the segments drawn in zoomed-in windows against a brute-force
+    test of all the segments, with and without the level of detail and a
+    selection. Raises an AssertionError if a segment crossing a window is
+    not drawn.
+    '''
+
+    xmin, xmax, ymin, ymax = layout.extent
+    nstruct = len(layout.parent)
+
+    for _ in range(nwindows):
+
+        x0, x1 = np.sort(xmin + (xmax - xmin) * rng.random(2))
+        y0, y1 = np.sort(ymin + (ymax - ymin) * rng.random(2))
+        max_leaves = None if rng.random() < 0.5 else float(rng.integers(1, 8))
+        selected = None if rng.random() < 0.5 else rng.random(nstruct) < 0.3
+
+        all_ids, verts = layout.segments(max_leaves=max_leaves, selected=selected)
+        crossing = ((verts[:, :, 0].max(axis=1) >= x0) & (verts[:, :, 0].min(axis=1) <= x1) &
+                    (verts[:, :, 1].max(axis=1) >= y0) & (verts[:, :, 1].min(axis=1) <= y1))
+
+        ids = layout.segments(max_leaves=max_leaves, selected=selected,
+                              window=(x0, x1, y0, y1))[0]
+
+        missing = np.setdiff1d(all_ids[crossing], ids)
+        assert len(missing) == 0, "{0} segments crossing the window " \
+                                  "({1}, {2}, {3}, {4}) are not drawn".format(len(missing), x0, x1, y0, y1)
+
+
+def roi_steps(layout, rng):
+    '''
+    The selections of every branch of `apply_roi`, and their conversion to
+    the ids of the data.
+    '''
+
+    xmin, xmax, ymin, ymax = layout.extent
+    # a tenth of the leaves, and the middle half of the heights
+    leaves = (xmin + (xmax - xmin) * 0.45, xmin + (xmax - xmin) * 0.55)
+    heights = (ymin + (ymax - ymin) * 0.25, ymin + (ymax - ymin) * 0.75)
+    point = (xmin + (xmax - xmin) * rng.random(), ymin + (ymax - ymin) * rng.random())
+
+    geometry = layout.geometry
+
+    steps = []
+    for orientation in ['bottom-up', 'left-right']:
+
+        sideways = orientation == 'left-right'
+
+        # the ROIs in the axes of the viewer
+        if sideways:
+            rois = {'point': point[::-1],
+                    'rectangle': heights + leaves,
+                    'xrange': heights,
+                    'yrange': leaves}
+        else:
+            rois = {'point': point,
+                    'rectangle': leaves + heights,
+                    'xrange': leaves,
+                    'yrange': heights}
+
+        for kind in ['point', 'rectangle', 'xrange', 'yrange']:
+            steps.append(('apply_roi {0} ({1})'.format(kind, orientation),
+                          lambda kind=kind, roi=rois[kind], sideways=sideways:
+                          geometry.select_roi(kind, roi, sideways=sideways)))
+
+    select = geometry.select(xmin=leaves[0], xmax=leaves[1], ymin=heights[0], ymax=heights[1])
+    steps.append(('apply_roi to_data',
+                  lambda: geometry.to_data(select)))
+    steps.append(('apply_roi to_data (substructures)',
+                  lambda: geometry.to_data(select, substruct=True)))
+
+    return steps
+
+
+def run_tree(name, parent, height, sortby, repeat, rng, length=None, newick=None):
+    '''
+    Times every step of the pipeline on one tree, and returns the results.
+    '''
+
+    results = []
+    nstruct = len(parent)
+
+    def record(step, func):
+        seconds, result = timeit(func, repeat)
+        results.append({'tree': name, 'size': nstruct, 'step': step,
+                        'seconds': seconds, 'throughput': nstruct / seconds})
+        print('{0:<28} {1:>9} {2:<38} {3:>10.4f} s {4:>12.3g} /s'.format(
+            name, nstruct, step, seconds, nstruct / seconds))
+        return result
+
+    if newick is not None:
+        record('parse', lambda: parse(newick))
+
+    if length is not None:
+        height = record('compute_heights', lambda: compute_heights(parent, length))
+
+    record('sort1Darrays', lambda: sort1Darrays(parent, height, sortby))
+    record('dendro_layout', lambda: dendro_layout(parent, height))
+
+    # the cached pipeline of the viewer: built once per parent array, once
+    # per sort key and once per height attribute
+    topology = record('TreeTopology', lambda: TreeTopology(parent))
+    tree = record('SortedTree', lambda: SortedTree(topology, sortby))
+    layout = record('TreeLayout', lambda: TreeLayout(tree, height))
+
+    # the colors of the Linear cmap mode
+    record('colormap', lambda: layout.colors(sortby, cm.viridis, np.min(sortby), np.max(sortby)))
+
+    max_leaves = layout.nleaf / float(PIXELS)
+    record('segments (level of detail)',
+           lambda: layout.segments(max_leaves=max(max_leaves, 1.)))
+
+    xmin, xmax, ymin, ymax = layout.extent
+    window = (xmin + (xmax - xmin) * 0.45, xmin + (xmax - xmin) * 0.55, ymin, ymax)
+    record('segments (zoomed in)', lambda: layout.segments(window=window))
+
+    figure = Figure(figsize=(PIXELS / 100., 6.), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+    collection = LineCollection([], linewidths=0.5)
+    axes.add_collection(collection)
+    axes.set_xlim(xmin, xmax)
+    axes.set_ylim(ymin, ymax)
+
+    record('draw (Agg)', lambda: draw(canvas, collection, layout, 'bottom-up'))
+    axes.set_xlim(ymin, ymax)
+    axes.set_ylim(xmin, xmax)
+    record('draw (Agg, sideways)', lambda: draw(canvas, collection, layout, 'left-right'))
+
+    # built on the first selection of the viewer
+    record('selection geometry',
+           lambda: SelectionGeometry(layout.parent, layout.height, layout.xpos, layout.order,
+                                     children=layout.children, x_order=tree.x_order))
+    for step, func in roi_steps(layout, rng):
+        record(step, func)
+
+    # the culling of zoomed-in views, also for heights that do not grow from
+    # parent to child (e.g. a size attribute)
+    check_segments(layout, rng)
+    check_segments(TreeLayout(tree, rng.random(nstruct)), rng)
+
+    return results
+
+
+def run_synthetic(shapes, sizes, repeat, seed):
+
+    results = []
+
+    for shape in shapes:
+        for size in sizes:
+            rng = np.random.default_rng(seed)
+            parent, length = TREES[shape](size, rng)
+            sortby = rng.random(size)
+            newick = to_newick(parent, length)
+            results.extend(run_tree(shape, parent, None, sortby, repeat, rng,
+                                    length=length, newick=newick))
+
+    return results
+
+
+def run_files(repeat, seed):
+
+    results = []
+
+    for file_name in sorted(os.listdir(DATA_DIR)):
+
+        path = os.path.join(DATA_DIR, file_name)
+        rng = np.random.default_rng(seed)
+
+        if file_name.endswith('.csv'):
+            try:
+                parent, height = read_csv_tree(path)
+            except ValueError:
+                # not a tree table
+                continue
+            results.extend(run_tree(file_name, parent, height, height, repeat, rng))
+
+        elif file_name.endswith(('.hdf5', '.fits')):
+            if DendroFile is None:
+                results.append({'tree': file_name, 'step': 'read',
+                                'skipped': CONFIG_ERROR})
+                print('{0:<28} {1:>9} {2:<38} skipped'.format(file_name, '', 'read'))
+                continue
+
+            def read():
+                return DendroFile(path).arrays
+
+            seconds, arrays = timeit(read, repeat)
+            nstruct = len(arrays['parent'])
+            results.append({'tree': file_name, 'size': nstruct, 'step': 'read',
+                            'seconds': seconds, 'throughput': nstruct / seconds})
+            print('{0:<28} {1:>9} {2:<38} {3:>10.4f} s {4:>12.3g} /s'.format(
+                file_name, nstruct, 'read', seconds, nstruct / seconds))
+
+            results.extend(run_tree(file_name, arrays['parent'], arrays['height'],
+                                    arrays['height'], repeat, rng))
+
+    return results
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the tree viewer layout and selection.")
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-files', action='store_true',
+                        help="skip the sample files under data/")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(args)
+
+    results = run_synthetic(args.shapes, args.sizes, args.repeat, args.seed)
+    if not args.no_files:
+        results.extend(run_files(args.repeat, args.seed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'matplotlib': matplotlib.__version__,
+                       'platform': platform.platform(),
+                       'repeat': args.repeat,
+                       'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,14 @@
 import os
-from operator import itemgetter
 
 import numpy as np
 
 from matplotlib.collections import LineCollection
 import matplotlib.cm as cm
-import matplotlib.colors as mplcolors
 from glue.config import viewer_tool
 from glue.viewers.common.qt.tool import CheckableTool
 
 from qtpy.QtWidgets import QWidget, QVBoxLayout, QCheckBox, QButtonGroup, QRadioButton, QHBoxLayout
+from qtpy.QtCore import QObject, Signal
 
 from glue.config import qt_client, colormaps
 from glue.core.data_combo_helper import ComponentIDComboHelper
@@ -31,13 +30,8 @@ from glue.viewers.matplotlib.qt.data_viewer import MatplotlibDataViewer
 from glue.utils.qt import load_ui, fix_tab_widget_fontsize, messagebox_on_error
 from glue.utils import defer_draw
 
-from dendro_helpers import (dendro_layout,
-                            calculate_nleaf,
-                            sort1Darrays,
-                            calculate_leafness,
-                            calculate_children,
-                            calculate_subtree,
-                            calculate_xpos)
+from dendro_helpers import orient_verts, calculate_is_leaf
+from layout_cache import LAYOUT_CACHE
 
 from glue.core.roi import PointROI, RectangularROI, XRangeROI, YRangeROI
 from glue.core.subset import CategorySubsetState
@@ -69,99 +63,648 @@ to do 'kind of' integration testing
 
 from glue.config import data_factory
 from glue.core import Data
+from glue.core.component import Component, CategoricalComponent
+from glue.core.subset import SubsetState
+from glue.core.exceptions import IncompatibleAttribute
 import numpy as np
-import re
+import hashlib
+import mmap
+
+from newick_parser import (parse_buffer, gather_ranges, NewickNames, index_newick,
+                           newick_arrays)
 
 
 def is_newick(filename, **kwargs):
     return filename.endswith('.nwk')
 
 
-def parse(newick):
-    tokens = re.findall(r"([^:;,()\s]*)(?:\s*:\s*([\d.]+)\s*)?([,);])|(\S)", newick+";")
+# suffix of the binary cache written next to a Newick file
+CACHE_SUFFIX = '.npz'
+
+
+def cache_stamp(file_name, nbytes=2 ** 16):
+    '''
+    Calculates the key identifying the current version of a file.
+
+    The key combines the modification time and size with a hash of the
+    first and last `nbytes` of the file, so it can be checked without
+    reading large files in full.
+    '''
+
+    stat = os.stat(file_name)
+
+    with open(file_name, 'rb') as f:
+        sha = hashlib.sha1(f.read(nbytes))
+        f.seek(max(stat.st_size - nbytes, 0))
+        sha.update(f.read())
+
+    return '{0}:{1}:{2}'.format(stat.st_mtime_ns, stat.st_size, sha.hexdigest())
+
+
+def read_tree_cache(file_name, stamp):
+    '''
+    Reads the tree index and, if present, the arrays of a single-tree file
+    from the cache next to `file_name`, if it was written for the version
+    `stamp` (see cache_stamp) of the file.
+
+    Returns (None, None) if there is no cache, if it is out of date or if
+    it cannot be read (e.g. an empty or truncated file).
+    '''
+
+    try:
+        with np.load(file_name + CACHE_SUFFIX) as cache:
+            if str(cache['stamp']) != stamp:
+                return None, None
+            return read_cache_arrays(cache)
+    except Exception:
+        # any cache that cannot be read is simply not used
+        return None, None
+
+
+def read_cache_arrays(cache):
+    # the contents of an open cache file, read into memory
+
+    index = [tuple(int(i) for i in row) for row in cache['index']]
+
+    if 'parent' not in cache:
+        return index, None
+
+    names = NewickNames(cache['names_blob'], cache['names_offset'], cache['names_length'])
+
+    arrays = {'parent': cache['parent'],
+              'names': names,
+              'size': cache['size'],
+              'height': cache['height']}
+
+    # the layout of the first sort shown, once it has been computed
+    if 'layout_sort_by' in cache:
+        sort_by = str(cache['layout_sort_by'])
+        arrays['layout'] = {'sort_by': sort_by if sort_by else None,
+                            'topology': {'order': cache['layout_topology_order']},
+                            'sorted': {'siblings': cache['layout_siblings'],
+                                       'order': cache['layout_order'],
+                                       'xpos': cache['layout_xpos']}}
+
+    return index, arrays
+
+
+def write_tree_cache(file_name, stamp, index, arrays=None):
+    '''
+    Writes the tree index and optionally the arrays of a single-tree file
+    to the cache next to `file_name`, with the arrays of its layout if
+    they are in `arrays` (see TreeLayoutCache).
+
+    `stamp` is the version of the file (see cache_stamp) the index and the
+    arrays were read from, taken before reading it: if the file changes
+    meanwhile, the cache is out of date as soon as it is written.
+
+    Failing to write the cache (e.g. in a read-only directory) is not an
+    error; the file is simply parsed again the next time.
+    '''
+
+    cache = {'stamp': stamp,
+             'index': np.array(index, dtype=np.int64).reshape(-1, 3)}
+
+    if arrays is not None:
+        names = arrays['names']
+        blob = gather_ranges(names.buf, names.offset,
+                             names.offset + names.length, 0)
+        cache['names_blob'] = np.frombuffer(blob, dtype=np.uint8)
+        cache['names_offset'] = np.cumsum(names.length + 1) - names.length - 1
+        cache['names_length'] = names.length
+        for key in ['parent', 'size', 'height']:
+            cache[key] = arrays[key]
+
+        layout = arrays.get('layout')
+        if layout is not None:
+            cache['layout_sort_by'] = layout['sort_by'] or ''
+            cache['layout_topology_order'] = layout['topology']['order']
+            for key in ['siblings', 'order', 'xpos']:
+                cache['layout_' + key] = layout['sorted'][key]
+
+    # write to a temporary file first so that readers never see a partial cache
+    tmp_name = file_name + '.tmp' + CACHE_SUFFIX
+    try:
+        np.savez(tmp_name, **cache)
+        os.replace(tmp_name, file_name + CACHE_SUFFIX)
+    except (IOError, OSError):
+        pass
+
+
+class NewickTree(object):
+    '''
+    A single tree in a Newick file, parsed the first time it is accessed.
+
+    The file is memory-mapped rather than read, and the node names are
+    kept as a table pointing into the mapped file.
+
+    The tree is also the layout store of its parent component: the first
+    layout computed for a single-tree file is saved in its cache, so that
+    the tree is not sorted and placed again when the file is reopened.
+    '''
+
+    def __init__(self, file_name, stamp, start, end, nnodes, cache=False, arrays=None):
+        self.file_name = file_name
+        # the version of the file the tree was indexed in
+        self.stamp = stamp
+        self.start = start
+        self.end = end
+        self.nnodes = nnodes
+        self.cache = cache
+        self._arrays = arrays
+        self._names = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            with open(self.file_name, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = np.frombuffer(mapped, dtype=np.uint8)[self.start:self.end]
+            self._arrays = newick_arrays(buf)
+            if self.cache:
+                write_tree_cache(self.file_name, self.stamp,
+                                 [(self.start, self.end, self.nnodes)],
+                                 self._arrays)
+        return self._arrays
+
+    @property
+    def names(self):
+        # decoded once, into the categorical component glue would make of
+        # a column of strings
+        if self._names is None:
+            self._names = CategoricalComponent(self.arrays['names'].decode())
+        return self._names
+
+    def load_layout(self):
+        return self.arrays.get('layout')
+
+    def save_layout(self, layout):
+        # called from the layout worker thread; only the first layout is
+        # kept, so reopening the file shows it without any computation
+        if not self.cache or 'layout' in self.arrays:
+            return
+        self.arrays['layout'] = layout
+        write_tree_cache(self.file_name, self.stamp,
+                         [(self.start, self.end, self.nnodes)], self.arrays)
+
+
+class NewickTreeComponent(Component):
+    '''
+    A component of a tree in a Newick file, which is only parsed once the
+    values are needed.
+    '''
+
+    def __init__(self, tree, key):
+        super(NewickTreeComponent, self).__init__(None, None)
+        self._tree = tree
+        self._key = key
+        # the layout is saved with the tree
+        self.layout_store = tree if key == 'parent' else None
+
+    @property
+    def data(self):
+        return self._tree.arrays[self._key]
+
+    @property
+    def shape(self):
+        return (self._tree.nnodes,)
+
+    @property
+    def ndim(self):
+        return 1
+
+    @property
+    def numeric(self):
+        return True
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class NewickNamesComponent(NewickTreeComponent):
+    '''
+    The names of the structures of a tree in a Newick file, as a categorical
+    component that is only built once the names are needed.
+    '''
+
+    def __init__(self, tree):
+        super(NewickNamesComponent, self).__init__(tree, 'names')
 
-    def recurse(nextid = 0, parentid = -1): # one node
-        thisid = nextid;
-        children = []
-        name, length, delim, ch = tokens.pop(0)
-        if ch == "(":
-            while ch in "(,":
-                node, ch, nextid = recurse(nextid+1, thisid)
-                children.append(node)
-            name, length, delim, ch = tokens.pop(0)
+    @property
+    def data(self):
+        return self._tree.names.data
 
-        return {"id": thisid, "name": name, "length": float(length) if length else None,
-                "parentid": parentid, "children": children}, delim, nextid
+    @property
+    def numeric(self):
+        return False
 
-    return recurse()[0]
+    @property
+    def categorical(self):
+        return True
 
-# names = []
-# size = []
-# parent = []
+    @property
+    def categories(self):
+        return self._tree.names.categories
 
-# def clear_arrays(names, size, parent):
-#     names.clear()
-#     size.clear()
-#     parent.clear()
-#     return names, size, parent
+    @property
+    def codes(self):
+        return self._tree.names.codes
 
+    @property
+    def labels(self):
+        return self._tree.names.labels
 
-def extract_arrays(tree_structure, names, parent, size):
-    names.append(tree_structure['name'])
-    parent.append(tree_structure['parentid'])
-    size.append(tree_structure['length'])
-    if tree_structure['children']:
-        for sub_dicts in tree_structure['children']:
-            extract_arrays(sub_dicts, names, parent, size)
+    def jitter(self, method=None):
+        return self._tree.names.jitter(method=method)
 
 
 @data_factory('Newick data loader', is_newick, priority=10000)
 def read_newick(file_name):
 
-    with open(file_name, 'r') as f:
-        newick_tree = f.readline()
+    # Index the trees in the newick file; each tree is only parsed
+    # (and converted into parent arrays) when its data is first used.
+    # Both the index and the arrays of single-tree files are cached
+    # next to the file, for the version of the file found before reading it.
+    stamp = cache_stamp(file_name)
+    trees, arrays = read_tree_cache(file_name, stamp)
+
+    if trees is None:
+        trees = index_newick(file_name)
+        if len(trees) > 1:
+            write_tree_cache(file_name, stamp, trees)
+
+    datasets = []
+
+    for itree, (start, end, nnodes) in enumerate(trees):
+
+        tree = NewickTree(file_name, stamp, start, end, nnodes,
+                          cache=(len(trees) == 1), arrays=arrays)
+
+        if len(trees) == 1:
+            data = Data(label='newick file')
+        else:
+            data = Data(label='newick file [tree {0}]'.format(itree))
+
+        data.add_component(NewickTreeComponent(tree, 'parent'), 'parent')
+        data.add_component(NewickNamesComponent(tree), 'names')
+        for key in ['size', 'height']:
+            data.add_component(NewickTreeComponent(tree, key), key)
+
+        datasets.append(data)
+
+    return datasets[0] if len(datasets) == 1 else datasets
+
+
+def is_astrodendro(filename, **kwargs):
+    # astrodendro output: an HDF5 file with the data, index map and newick
+    # tree, or a FITS file with those in HDUs 1, 2 and 3
+    if filename.endswith(('.hdf5', '.h5')):
+        try:
+            import h5py
+        except ImportError:
+            return False
+        with h5py.File(filename, 'r') as f:
+            return all(key in f for key in ('data', 'index_map', 'newick'))
+
+    if filename.endswith(('.fits', '.fit')):
+        try:
+            from astropy.io import fits
+        except ImportError:
+            return False
+        with fits.open(filename, memmap=True) as hdus:
+            # the newick string is stored as an integer array of characters
+            return (len(hdus) == 4 and hdus[3].header.get('NAXIS') == 1 and
+                    hdus[3].header.get('BITPIX', 0) > 0)
+
+    return False
+
+
+class DendroFile(object):
+    '''
+    An astrodendro file.
+
+    The newick tree is read when the file is opened. The data and the index
+    map are only accessed when they are needed: FITS images and contiguous
+    (uncompressed) HDF5 datasets are memory-mapped, and compressed HDF5
+    datasets are read through h5py.
+    '''
+
+    def __init__(self, file_name):
+
+        self.file_name = file_name
+        self.is_hdf5 = not file_name.endswith(('.fits', '.fit'))
+
+        if self.is_hdf5:
+            import h5py
+            with h5py.File(file_name, 'r') as f:
+                newick = f['newick'][()]
+                self.shape = f['data'].shape
+        else:
+            from astropy.io import fits
+            with fits.open(file_name, memmap=True) as hdus:
+                newick = hdus[3].data.astype(np.uint8).tobytes()
+                self.shape = hdus[1].shape
+
+        if not isinstance(newick, bytes):
+            newick = newick.encode()
+
+        self.newick = np.frombuffer(newick, dtype=np.uint8)
+        self._images = {}
+        self._arrays = None
+        self._pixel_index = None
+
+    def image(self, key):
+        '''
+        The 'data' or 'index_map' image, as a memory map if possible.
+        '''
+
+        if key not in self._images:
+
+            if self.is_hdf5:
+                import h5py
+                with h5py.File(self.file_name, 'r') as f:
+                    dataset = f[key]
+                    offset = dataset.id.get_offset()
+                    if offset is not None and dataset.chunks is None:
+                        image = np.memmap(self.file_name, mode='r', dtype=dataset.dtype,
+                                          offset=offset, shape=dataset.shape)
+                    else:
+                        image = dataset[()]
+            else:
+                from astropy.io import fits
+                hdus = fits.open(self.file_name, memmap=True)
+                image = hdus[1 if key == 'data' else 2].data
+
+            self._images[key] = image
+
+        return self._images[key]
+
+    def iter_blocks(self, nrows=256):
+        '''
+        Iterates over the data and the index map in blocks of rows (along
+        the first axis), without holding the whole images in memory.
+        '''
+
+        if self.is_hdf5:
+            import h5py
+            with h5py.File(self.file_name, 'r') as f:
+                data, index_map = f['data'], f['index_map']
+                for start in range(0, self.shape[0], nrows):
+                    yield data[start:start + nrows], index_map[start:start + nrows]
+        else:
+            data, index_map = self.image('data'), self.image('index_map')
+            for start in range(0, self.shape[0], nrows):
+                yield data[start:start + nrows], index_map[start:start + nrows]
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = dendro_arrays(self)
+        return self._arrays
+
+    @property
+    def pixel_index(self):
+        if self._pixel_index is None:
+            self._pixel_index = StructurePixelIndex(self)
+        return self._pixel_index
+
+
+def dendro_arrays(dfile):
+    '''
+    Calculates the components of the tree data of an astrodendro file.
+
+    The tree comes from the newick string, in which the structures are
+    labelled by their ids (the values of the index map); the unlabelled root
+    joins the trunks of the dendrogram. As in astrodendro, the height of a
+    leaf is its largest value and the height of a branch is the smallest
+    value of its children, computed in one pass over the pixels.
+    '''
+
+    parent, names, _ = parse_buffer(dfile.newick)
+
+    labelled = names.length > 0
+    structure = np.full(len(parent), -1, dtype=int)
+    structure[labelled] = names.decode(labelled).astype(int)
+
+    # extreme values of the pixels of each structure (without the pixels
+    # of its substructures, which have their own ids in the index map)
+    nstruct = structure.max() + 1
+    vmin = np.full(nstruct, np.inf)
+    vmax = np.full(nstruct, -np.inf)
+
+    for data, index_map in dfile.iter_blocks():
+        inside = index_map >= 0
+        np.fmin.at(vmin, index_map[inside], data[inside])
+        np.fmax.at(vmax, index_map[inside], data[inside])
+
+    height = np.full(len(parent), np.inf)
+    is_leaf = calculate_is_leaf(parent)
+    height[is_leaf] = vmax[structure[is_leaf]]
+    child = np.nonzero(parent >= 0)[0]
+    np.minimum.at(height, parent[child], vmin[structure[child]])
+
+    return {'parent': parent,
+            'structure': structure,
+            'height': height}
+
+
+class DendroComponent(Component):
+    '''
+    A component of an astrodendro file (of the tree or of the images),
+    which is only read once the values are needed.
+    '''
+
+    def __init__(self, dfile, key):
+        super(DendroComponent, self).__init__(None, None)
+        self._dfile = dfile
+        self._key = key
+
+    @property
+    def data(self):
+        if self._key in ('data', 'index_map'):
+            return self._dfile.image(self._key)
+        return self._dfile.arrays[self._key]
+
+    @property
+    def shape(self):
+        if self._key in ('data', 'index_map'):
+            return self._dfile.shape
+        return (len(self._dfile.arrays['parent']),)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def numeric(self):
+        return True
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class StructurePixelIndex(object):
+    '''
+    The pixels of every structure of an astrodendro index map, in CSR form.
+
+    The (flat) pixels of structure `idx` are
+    `pixels[offsets[idx]:offsets[idx + 1]]`. The index is built in one pass
+    over the index map, so that the pixels of a selection of structures can
+    be found in proportion to their number.
+    '''
+
+    def __init__(self, dfile):
+
+        self.shape = dfile.shape
+
+        ids, pixels = [], []
+        start = 0
+        for _, index_map in dfile.iter_blocks():
+            flat = np.ravel(index_map)
+            inside = np.nonzero(flat >= 0)[0]
+            ids.append(flat[inside])
+            pixels.append(inside + start)
+            start += flat.size
+
+        ids = np.concatenate(ids)
+        self.pixels = np.concatenate(pixels)[np.argsort(ids, kind='stable')]
+
+        counts = np.bincount(ids, minlength=1)
+        self.offsets = np.zeros(len(counts) + 1, dtype=int)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def pixels_of(self, structures):
+        '''
+        The flat pixels of the given structures (ids in the index map).
+        '''
+
+        structures = np.asarray(structures, dtype=int)
+        structures = structures[(structures >= 0) & (structures < len(self))]
+
+        start = self.offsets[structures]
+        length = self.offsets[structures + 1] - start
+
+        # concatenated ranges: each pixel is its range start plus its rank
+        # within the range
+        shift = np.repeat(start - (np.cumsum(length) - length), length)
+        return self.pixels[shift + np.arange(np.sum(length))]
+
+    def mask(self, structures):
+        '''
+        The image mask of the pixels of the given structures.
+        '''
+
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.pixels_of(structures)] = True
+
+        return mask
+
+    def structures(self, index_map, mask):
+        '''
+        The structures with pixels in an image mask (e.g. an ROI on the
+        image), from the index map values of the masked pixels only.
+        '''
+
+        ids = np.asarray(index_map)[mask]
+        ids = ids[ids >= 0]
+
+        return np.nonzero(np.bincount(ids, minlength=len(self)))[0]
+
+
+class StructureSubsetState(SubsetState):
+    '''
+    A selection of astrodendro structures (by their ids in the index map).
+
+    In the image, the pixels of the structures are looked up in the CSR
+    pixel index rather than by matching every pixel of the index map; the
+    tree data is matched on its structure ids. An image mask can be turned
+    into a selection of structures with `from_image_mask`.
+    '''
+
+    def __init__(self, dfile, structures):
+        super(StructureSubsetState, self).__init__()
+        self.dfile = dfile
+        self.structures = np.unique(np.asarray(structures, dtype=int))
 
-    # Open and parse newick file
-    # convert newick file into parent array
-    names = []
-    size = []
-    parent = []
+    @classmethod
+    def from_image_mask(cls, dfile, mask):
+        return cls(dfile, dfile.pixel_index.structures(dfile.image('index_map'), mask))
 
-    newick_in = parse(newick_tree)
-    # names, size, parent = clear_arrays(names, size, parent)
-    extract_arrays(newick_in, names, parent, size)
+    def to_mask(self, data, view=None):
 
-    # TODO
-    # optimize this
-    # currently storing everything in a
-    # test object and then
-    # using the test object to calculate height
+        key = dendro_component_key(data, self.dfile)
 
-    if (size[0] == None):
-        size[0] = 0
+        if key == 'index_map':
+            mask = self.dfile.pixel_index.mask(self.structures)
+        elif key == 'structure':
+            structure = self.dfile.arrays['structure']
+            # the structure ids of the tree are unique, and at most one of
+            # them (the root) is not in the index map
+            lookup = np.zeros(structure.max() + 2, dtype=bool)
+            lookup[self.structures[self.structures < len(lookup) - 1]] = True
+            mask = lookup[structure]
+        else:
+            raise IncompatibleAttribute()
+
+        if view is not None:
+            mask = mask[view]
+
+        return mask
+
+    def copy(self):
+        return StructureSubsetState(self.dfile, self.structures)
+
+
+def dendro_component_key(data, dfile=None):
+    '''
+    The key of the astrodendro component ('structure' for the tree data,
+    'index_map' for the image) of `data`, or None if `data` does not come
+    from an astrodendro file (or not from `dfile`).
+    '''
+
+    for key in ('structure', 'index_map'):
+        for cid in data.components:
+            comp = data.get_component(cid)
+            if (isinstance(comp, DendroComponent) and comp._key == key and
+                    (dfile is None or comp._dfile is dfile)):
+                return key
+
+    return None
+
+
+def dendro_file(data):
+    '''
+    The astrodendro file the tree `data` was read from, if any.
+    '''
+
+    if dendro_component_key(data) != 'structure':
+        return None
+
+    return data.get_component(data.id['structure'])._dfile
 
-    data = Data(label='newick file')
-    data['parent'] = parent
-    data['names'] = names
-    data['size'] = size
 
-    heights = np.zeros(len(data['parent']))
-    idx = np.array(range(len(data['parent'])))
+@data_factory('astrodendro data loader', is_astrodendro, priority=10000)
+def read_astrodendro(file_name):
 
-    for pix in idx:
-        heights[idx[(data['parent'] == pix)]] += (data['size'][pix] + heights[pix])
+    # Mirrors glue's dendrogram loader: the tree and the image are two
+    # datasets, linked by the structure ids of the index map.
+    dfile = DendroFile(file_name)
+    label = os.path.splitext(os.path.basename(file_name))[0]
 
-    heights = heights + data['size']
+    dendro = Data(label='{0} [dendrogram]'.format(label))
+    for key in ['parent', 'structure', 'height']:
+        dendro.add_component(DendroComponent(dfile, key), key)
 
-    data['height'] = heights
+    image = Data(label='{0} [data]'.format(label))
+    image.add_component(DendroComponent(dfile, 'data'), 'intensity')
+    image.add_component(DendroComponent(dfile, 'index_map'), 'structure')
 
-    # data = Data(label='newick file')
-    # data['parent'] = parent
-    # data['names'] = names
-    # data['size'] = size
-    # data['height'] = [0,0.1,0.2,0.5,0.8,.9,.35,.6,.75,.85,.9,0.25,.3,.4,.5]
+    image.join_on_key(dendro, image.id['structure'], dendro.id['structure'])
 
-    return data
+    return [dendro, image]
 
 
 """
@@ -186,6 +729,7 @@ class TutorialViewerState(MatplotlibDataViewerState):
     orientation = SelectionCallbackProperty(docstring='The orientation ....')
     sort_by = SelectionCallbackProperty(docstring='Sort by option ....')
     select_substruct = DDCProperty(True)
+    lod = DDCProperty(True, docstring='Whether to collapse subtrees narrower than a pixel')
 
 
     def __init__(self, *args, **kwargs):
@@ -217,6 +761,14 @@ class TutorialViewerState(MatplotlibDataViewerState):
                 self.x_axislabel = self.y_att.label
                 self.y_axislabel = ''
 
+    def selection_geometry(self):
+        # the geometry lives on the shared layout, so it is built once per
+        # layout and reused by every ROI (and every viewer) until the
+        # attributes, sorting or data change
+        layout = LAYOUT_CACHE.get(self.layers_data[0], self.x_att, self.y_att,
+                                  self.sort_by)
+        return layout.geometry
+
 
 class TutorialLayerState(MatplotlibLayerState):
 
@@ -259,6 +811,12 @@ class TutorialLayerState(MatplotlibLayerState):
             self.cmap = colormaps.members[0][1]
 
 
+class LayoutNotifier(QObject):
+    # emitted from the layout worker thread with the finished future, and
+    # delivered in the Qt main thread
+    ready = Signal(object)
+
+
 class TutorialLayerArtist(MatplotlibLayerArtist):
     _layer_state_cls = TutorialLayerState
 
@@ -277,63 +835,192 @@ class TutorialLayerArtist(MatplotlibLayerArtist):
         self.state.add_callback('alpha', self._on_visual_change)
         self.state.add_callback('linewidth', self._on_visual_change)
         #
-        self.state.add_callback('cmap_mode', self._on_visual_change)
-        self.state.add_callback('cmap_att', self._on_visual_change)
-        self.state.add_callback('cmap_vmin', self._on_visual_change)
-        self.state.add_callback('cmap_vmax', self._on_visual_change)
-        self.state.add_callback('cmap', self._on_visual_change)
+        self._colors = None
+        self._segment_ids = None
+        self._selected = None
+        self._segments_key = None
+        # the layout on display, and the one being computed
+        self._layout = None
+        self._pending = None
+        self._notifier = LayoutNotifier()
+        self._notifier.ready.connect(self._on_layout_ready)
+        for prop in sorted(CMAP_PROPERTIES):
+            self.state.add_callback(prop, self._on_cmap_change)
 
         self._viewer_state.add_callback('x_att', self._on_attribute_change)
         self._viewer_state.add_callback('y_att', self._on_attribute_change)
-        self._viewer_state.add_callback('orientation', self._on_attribute_change)
+        self._viewer_state.add_callback('orientation', self._on_orientation_change)
         self._viewer_state.add_callback('sort_by', self._on_attribute_change)
+        self._viewer_state.add_callback('lod', self._on_limits_change)
+        for lim in ['x_min', 'x_max', 'y_min', 'y_max']:
+            self._viewer_state.add_callback(lim, self._on_limits_change)
+
+
+    def _get_layout(self):
+        # the layout on display (None until the first one is ready)
+        return self._layout
+
+    def _request_layout(self):
+        # the layout is cached and shared by all the layers of the data; it
+        # is computed in the background, and a newer request supersedes the
+        # pending one
+        future = LAYOUT_CACHE.request(self.state.layer.data,
+                                      self._viewer_state.x_att,
+                                      self._viewer_state.y_att,
+                                      self._viewer_state.sort_by)
+
+        if self._pending is not None:
+            LAYOUT_CACHE.release(self._pending)
+        self._pending = future
+
+        if future.done():
+            self._on_layout_ready(future)
+        else:
+            future.add_done_callback(self._notifier.ready.emit)
+
+    def _cancel_layout(self):
+        # gives up on the layout being computed; it is ignored if it still
+        # arrives (see _on_layout_ready)
+        if self._pending is not None:
+            LAYOUT_CACHE.release(self._pending)
+            self._pending = None
+
+    def clear(self):
+        self._cancel_layout()
+        super(TutorialLayerArtist, self).clear()
+
+    def remove(self):
+        self._cancel_layout()
+        # nothing is drawn any more, so the limits callbacks have nothing
+        # to update and the shared layout is not kept alive
+        self._layout = None
+        self._colors = None
+        self._selected = None
+        self._segment_ids = None
+        self._segments_key = None
+        super(TutorialLayerArtist, self).remove()
+
+    def _get_colors(self, layout):
+        # RGBA colors of all the line segments in the Linear cmap mode,
+        # cached until the layout, the cmap properties or the data change.
+        color_code_by = self.state.layer.data[self.state.cmap_att]
+
+        if (self._colors is None or self._colors[0] is not layout or
+                self._colors[1] is not color_code_by):
+
+            colors = layout.colors(color_code_by, self.state.cmap,
+                                   self.state.cmap_vmin, self.state.cmap_vmax)
+
+            self._colors = (layout, color_code_by, colors)
+
+        colors = self._colors[2]
+
+        # only the colors of the segments that are drawn
+        if self._segment_ids is not None and self._segment_ids[0] is layout:
+            colors = colors[self._segment_ids[1]]
+
+        return colors
+
+    def _view(self, layout):
+        # the visible window in the coordinates of the bottom-up layout
+        # (leaf axis first), and the number of leaf positions per pixel
+        bbox = self.axes.get_window_extent()
+        xlim = sorted(self.axes.get_xlim())
+        ylim = sorted(self.axes.get_ylim())
+
+        if self._viewer_state.orientation in ['left-right', 'right-left']:
+            window = tuple(ylim + xlim)
+            pixels = bbox.height
+        else:
+            window = tuple(xlim + ylim)
+            pixels = bbox.width
 
+        return window, (window[1] - window[0]) / max(pixels, 1.)
 
-    def _on_visual_change(self, value=None):
+    def _update_segments(self, layout):
+        # the segments drawn for the layer: the segments of the shared
+        # layout, restricted to the subset and to the visible window, at a
+        # coarser level of detail when more than one leaf falls on a pixel
+        selected = None
+        if isinstance(self.state.layer, Subset):
+            if self._selected is None or self._selected[0] is not layout:
+                self._selected = (layout, layout.selected(self.state.layer.to_index_list()))
+            selected = self._selected[1]
+
+        window, leaves_per_pixel = self._view(layout)
+
+        if not self._viewer_state.lod or leaves_per_pixel <= 1.:
+            leaves_per_pixel = None
+
+        # no culling when the whole tree is in view
+        xmin, xmax, ymin, ymax = layout.extent
+        if (window[0] <= xmin and window[1] >= xmax and
+                window[2] <= ymin and window[3] >= ymax):
+            window = None
+
+        orientation = self._viewer_state.orientation
+        key = (layout, selected, leaves_per_pixel, window, orientation)
+        # the layout and the subset mask are compared by identity (the key
+        # holds on to the mask, so a new mask is never mistaken for it)
+        last = self._segments_key
+        if (last is not None and last[0] is layout and last[1] is selected and
+                last[2:] == key[2:]):
+            return
+        self._segments_key = key
+
+        if leaves_per_pixel is None and selected is None and window is None:
+            segment_ids, verts = None, layout.verts
+        else:
+            segment_ids, verts = layout.segments(max_leaves=leaves_per_pixel,
+                                                 selected=selected,
+                                                 window=window)
+
+        self._segment_ids = None if segment_ids is None else (layout, segment_ids)
+
+        if self.state.cmap_mode == 'Linear' and self.state.cmap_att is not None:
+            self.lc.set_color(self._get_colors(layout))
+
+        self.lc.set_segments(orient_verts(verts, orientation))
+
+    def _on_limits_change(self, value=None):
+
+        if self._viewer_state.x_att is None or self._viewer_state.y_att is None:
+            return
 
-        # parent
-        x = self.state.layer.data[self._viewer_state.x_att]
-        # height
-        y = self.state.layer.data[self._viewer_state.y_att]
         if len(self.state.layer[self._viewer_state.x_att]) == 0:
             return
 
-        orientation = self._viewer_state.orientation
-        sort_by_array = self.state.layer.data[self._viewer_state.sort_by]
-        x, y, iter_array_updated = sort1Darrays(x, y, sort_by_array)
-        verts, verts_horiz = dendro_layout(x, y, orientation=orientation)
+        if self._layout is None:
+            return
 
+        self._update_segments(self._layout)
+        self.redraw()
 
-        self.artist.set_visible(self.state.visible)
-        self.artist.set_zorder(self.state.zorder)
+    def _on_cmap_change(self, value=None):
+        self._colors = None
+        self._on_visual_change()
 
-        ## set colors
-        if self.state.cmap_mode is not None:
-            color_code = self.state.cmap_mode
-            color_code_by = self.state.layer.data[self.state.cmap_att]
-            color_code_by = color_code_by[iter_array_updated]
-            color_code_cmap = self.state.cmap
-            color_code_vmin = self.state.cmap_vmin
-            color_code_vmax = self.state.cmap_vmax
-        else:
-            color_code = 'Fixed'
+    def _on_visual_change(self, value=None):
 
+        if self._viewer_state.x_att is None or self._viewer_state.y_att is None:
+            return
 
-        if color_code == 'Fixed':
+        if len(self.state.layer[self._viewer_state.x_att]) == 0:
+            return
 
-            colors_final = self.state.color
+        layout = self._get_layout()
 
-        elif color_code == 'Linear':
+        if layout is None:
+            return
 
-            cmap = color_code_cmap
-            normalize = mplcolors.Normalize(color_code_vmin, color_code_vmax)
-            colors = [cmap(normalize(yi)) for yi in color_code_by]
-            colors_horiz = []
-            
-            for i in range(len(verts_horiz)):
-                colors_horiz.append((0., 0., 0., 1.))
+        self.artist.set_visible(self.state.visible)
+        self.artist.set_zorder(self.state.zorder)
 
-            colors_final = np.concatenate([colors, colors_horiz])
+        ## set colors
+        if self.state.cmap_mode == 'Linear' and self.state.cmap_att is not None:
+            colors_final = self._get_colors(layout)
+        else:
+            colors_final = self.state.color
 
         self.lc.set_color(colors_final)
 
@@ -355,77 +1042,46 @@ class TutorialLayerArtist(MatplotlibLayerArtist):
         if self._viewer_state.x_att is None or self._viewer_state.y_att is None:
             return
 
-        # parent
-        x = self.state.layer.data[self._viewer_state.x_att]
-        # height
-        y = self.state.layer.data[self._viewer_state.y_att]
-
         if len(self.state.layer[self._viewer_state.x_att]) == 0:
             return
 
-        leafness = calculate_leafness(x)
-
-
-        orientation = self._viewer_state.orientation
-
-        # sort_by_array = None for using the original order
-        # sort_by_array = y for sort by height
-        sort_by_array = self.state.layer.data[self._viewer_state.sort_by]
-        x, y, iter_array_updated = sort1Darrays(x, y, sort_by_array)
+        # the old layout stays on display until the new one is ready
+        self._request_layout()
 
-        verts, verts_horiz = dendro_layout(x, y, orientation=orientation)
-        if isinstance(self.state.layer, Subset):
-            subset_mask = self.state.layer.to_index_list()
-            subset_mask = np.array([ID in subset_mask for ID in iter_array_updated])
-            subset_mask = np.where(subset_mask)[0]
-            verts = itemgetter(*subset_mask)(verts)
-            #id_horiz = np.where([ID in np.where(np.array(leafness) == 'branch')[0] for ID in subset_mask])[0]
-            #id_horiz = np.where((subset_mask in id_horiz))
-            verts_horiz = []
-
-        verts = verts if (np.ndim(verts) == 3.) else [verts]
-        #verts_horiz = verts_horiz if (np.ndim(verts_horiz) == 3.) else [verts_horiz]
-
-        nleaf = calculate_nleaf(x)
-
-        if len(verts_horiz) != 0.:
-            verts_final = np.concatenate([verts, verts_horiz])
-        else:
-            verts_final = verts
+    def _on_layout_ready(self, future):
 
+        # superseded or cancelled
+        if future is not self._pending or future.cancelled():
+            return
 
-        if self.state.cmap_mode is 'Linear':
-            color_code = self.state.cmap_mode
-            color_code_by = self.state.layer.data[self.state.cmap_att]
-            color_code_by = color_code_by[iter_array_updated]
-            color_code_cmap = self.state.cmap
-            color_code_vmin = self.state.cmap_vmin
-            color_code_vmax = self.state.cmap_vmax
+        LAYOUT_CACHE.release(future)
+        self._pending = None
 
+        self._layout = future.result()
 
-            cmap = color_code_cmap
-            normalize = mplcolors.Normalize(color_code_vmin, color_code_vmax)
+        # the subset may have changed
+        self._selected = None
 
-            print(cmap, color_code_vmin, color_code_vmax, color_code_by)
+        self._apply_layout(self._layout)
 
-            colors = [cmap(normalize(yi)) for yi in color_code_by]
-            colors_horiz = []
-            for i in range(len(verts_horiz)):
-                colors_horiz.append((0., 0., 0., 1.))
+    def _on_orientation_change(self, value=None):
+        # the layouts do not depend on the orientation, so the one on
+        # display is only redrawn with swapped axes and/or flipped limits
+        if self._layout is not None:
+            self._apply_layout(self._layout)
 
-            colors_final = np.concatenate([colors, colors_horiz])
+    def _apply_layout(self, layout):
 
-            self.lc.set_color(colors_final)
+        orientation = self._viewer_state.orientation
 
-        # self.artist.set_data(x, y)
-        self.lc.set_segments(verts_final)
+        nleaf = layout.nleaf
 
 
         # parent
         xmin = (-.5)
         xmax = nleaf + 1.5
         # height
-        ymin, ymax = np.nanmin(y), np.nanmax(y)
+        ymin, ymax = layout.height_range
 
 
         # y_log = True
@@ -529,8 +1185,11 @@ class TutorialLayerArtist(MatplotlibLayerArtist):
             # if y_log:
             #     self.axes.set_xscale('log')
 
+        # the segments depend on the new limits (level of detail)
+        self._update_segments(layout)
 
-        self.redraw()
+        # styles the new segments and redraws
+        self._on_visual_change()
 
     def update(self):
         self._on_attribute_change()
@@ -580,38 +1239,9 @@ class TutorialLayerStyleEditor(QWidget):
 
         self.layer_state = layer.state
         self.layer_state.add_callback('cmap_mode', self._update_cmap_mode)
-        self.layer_state.add_callback('layer', self._update_warnings)
 
         self._update_cmap_mode()
 
-        self._update_warnings()
-
-    def _update_warnings(self, *args):
-
-        if self.layer_state.layer is None:
-            n_points = 0
-        else:
-            n_points = np.product(self.layer_state.layer.shape)
-
-        warning = " (may be slow given data size)"
-
-        for combo, threshold in [(self.ui.combosel_cmap_mode, 50000)]:
-
-            if n_points > threshold and not self.layer_state.density_map:
-                for item in range(combo.count()):
-                    text = combo.itemText(item)
-                    if text != 'Fixed':
-                        combo.setItemText(item, text + warning)
-                        combo.setItemData(item, QtGui.QBrush(Qt.red), Qt.TextColorRole)
-            else:
-                for item in range(combo.count()):
-                    text = combo.itemText(item)
-                    if text != 'Fixed':
-                        if warning in text:
-                            combo.setItemText(item, text.replace(warning, ''))
-                            combo.setItemData(item, QtGui.QBrush(), Qt.TextColorRole)
-
-
     def _update_line_visible(self, *args):
         self.ui.value_linewidth.setEnabled(self.layer_state.line_visible)
         self.ui.combosel_linestyle.setEnabled(self.layer_state.line_visible)
@@ -707,225 +1337,38 @@ class TutorialDataViewer(MatplotlibDataViewer):
         if len(self.layers) == 0:
             return
 
-        if isinstance(roi, PointROI):
-
-            x, y = roi.x, roi.y
-
-            # calculate everything
-            parent = self.state.layers_data[0][self.state.x_att]
-            ys = self.state.layers_data[0][self.state.y_att]
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = ys[parent]
-            parent_ys[0] = ys[0]
-
-            # sort everything
-            sort_by_array = self.state.layers_data[0][self.state.sort_by]
-            parent, ys, iter_array_updated = sort1Darrays(parent, ys, sort_by_array)
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = parent_ys[np.asarray(iter_array_updated, dtype = np.int)]
-
-            orientation = self.state.orientation
-
-            if orientation in ['bottom-up', 'top-down']:
-                delt = np.abs(x - xs)
-                delt[y > ys] = np.nan
-                delt[y < parent_ys] = np.nan
-            elif orientation in ['left-right', 'right-left']:
-                delt = np.abs(y - xs)
-                delt[x > ys] = np.nan
-                delt[x < parent_ys] = np.nan
-
-            if np.isfinite(delt).any():
-                select = np.nanargmin(delt)
-
-                if self.state.select_substruct:
-                    #leafness = calculate_leafness(parent)
-                    subtree = calculate_subtree(parent, leafness)
-                    select = np.concatenate([[int(select)],
-                                             np.asarray(subtree[select], dtype = np.int)])
-                select = np.asarray(select, dtype=np.int)
-            else:
-                select = np.array([], dtype=np.int)
-
-            select = iter_array_updated[select]
-            subset_state = CategorySubsetState(self.state.layers_data[0].components[0], select)
+        geometry = self.state.selection_geometry()
 
-            self.apply_subset_state(subset_state)
+        # the geometry is in the coordinates of the bottom-up layout, so
+        # the ROI axes are swapped for the sideways orientations
+        sideways = self.state.orientation in ['left-right', 'right-left']
 
+        if isinstance(roi, PointROI):
+            kind, bounds = 'point', (roi.x, roi.y)
         elif isinstance(roi, RectangularROI):
-
-            xmin, xmax = roi.xmin, roi.xmax
-            ymin, ymax = roi.ymin, roi.ymax
-
-
-            # calculate everything
-            parent = self.state.layers_data[0][self.state.x_att]
-            ys = self.state.layers_data[0][self.state.y_att]
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = ys[parent]
-            parent_ys[0] = ys[0]
-
-            # sort everything
-            sort_by_array = self.state.layers_data[0][self.state.sort_by]
-            parent, ys, iter_array_updated = sort1Darrays(parent, ys, sort_by_array)
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = parent_ys[np.asarray(iter_array_updated, dtype = np.int)]
-
-            orientation = self.state.orientation
-
-            if orientation in ['bottom-up', 'top-down']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[xs < xmin] = np.nan
-                delt[xs > xmax] = np.nan
-                delt[ymin > ys] = np.nan
-                delt[ymax < parent_ys] = np.nan
-            elif orientation in ['left-right', 'right-left']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[xs < ymin] = np.nan
-                delt[xs > ymax] = np.nan
-                delt[xmin > ys] = np.nan
-                delt[xmax < parent_ys] = np.nan
-
-            if np.isfinite(delt).any():
-                select = np.where(np.isfinite(delt))[0]
-
-                if self.state.select_substruct:
-
-                    subtree = calculate_subtree(parent, leafness)
-
-                    for sl in select:
-
-                        select = np.concatenate([select,
-                                                 np.asarray(subtree[sl], dtype = np.int)])
-
-                select = np.asarray(select, dtype=np.int)
-            else:
-                select = np.array([], dtype=np.int)
-
-            select = iter_array_updated[select]
-            subset_state = CategorySubsetState(self.state.layers_data[0].components[0], select)
-
-            self.apply_subset_state(subset_state)
-
-
-
+            kind, bounds = 'rectangle', (roi.xmin, roi.xmax, roi.ymin, roi.ymax)
         elif isinstance(roi, XRangeROI):
-
-            xmin, xmax = roi.min, roi.max
-
-            # calculate everything
-            parent = self.state.layers_data[0][self.state.x_att]
-            ys = self.state.layers_data[0][self.state.y_att]
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = ys[parent]
-            parent_ys[0] = ys[0]
-
-            # sort everything
-            sort_by_array = self.state.layers_data[0][self.state.sort_by]
-            parent, ys, iter_array_updated = sort1Darrays(parent, ys, sort_by_array)
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = parent_ys[np.asarray(iter_array_updated, dtype = np.int)]
-
-            orientation = self.state.orientation
-
-            if orientation in ['bottom-up', 'top-down']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[xs < xmin] = np.nan
-                delt[xs > xmax] = np.nan
-            elif orientation in ['left-right', 'right-left']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[xmin > ys] = np.nan
-                delt[xmax < parent_ys] = np.nan
-
-            if np.isfinite(delt).any():
-                select = np.where(np.isfinite(delt))[0]
-
-                if self.state.select_substruct:
-
-                    subtree = calculate_subtree(parent, leafness)
-
-                    for sl in select:
-
-                        select = np.concatenate([select,
-                                                 np.asarray(subtree[sl], dtype = np.int)])
-
-                select = np.asarray(select, dtype=np.int)
-            else:
-                select = np.array([], dtype=np.int)
-
-            select = iter_array_updated[select]
-            subset_state = CategorySubsetState(self.state.layers_data[0].components[0], select)
-
-            self.apply_subset_state(subset_state)
-
-
-
+            kind, bounds = 'xrange', (roi.min, roi.max)
         elif isinstance(roi, YRangeROI):
+            kind, bounds = 'yrange', (roi.min, roi.max)
+        else:
+            raise TypeError("Only PointROI selections are supported")
 
-            ymin, ymax = roi.min, roi.max
-
-            # calculate everything
-            parent = self.state.layers_data[0][self.state.x_att]
-            ys = self.state.layers_data[0][self.state.y_att]
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = ys[parent]
-            parent_ys[0] = ys[0]
-
-            # sort everything
-            sort_by_array = self.state.layers_data[0][self.state.sort_by]
-            parent, ys, iter_array_updated = sort1Darrays(parent, ys, sort_by_array)
-            leafness = calculate_leafness(parent)
-            children = calculate_children(parent, leafness)
-            xs = calculate_xpos(parent, leafness, children)
-            parent_ys = parent_ys[np.asarray(iter_array_updated, dtype = np.int)]
-
-            orientation = self.state.orientation
-
-            if orientation in ['bottom-up', 'top-down']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[ymin > ys] = np.nan
-                delt[ymax < parent_ys] = np.nan
-            elif orientation in ['left-right', 'right-left']:
-                delt = np.arange(len(xs), dtype = np.float)
-                delt[xs < ymin] = np.nan
-                delt[xs > ymax] = np.nan
-
-            if np.isfinite(delt).any():
-                select = np.where(np.isfinite(delt))[0]
-
-                if self.state.select_substruct:
-
-                    subtree = calculate_subtree(parent, leafness)
-
-                    for sl in select:
-
-                        select = np.concatenate([select,
-                                                 np.asarray(subtree[sl], dtype = np.int)])
+        select = geometry.select_roi(kind, bounds, sideways=sideways)
 
-                select = np.asarray(select, dtype=np.int)
-            else:
-                select = np.array([], dtype=np.int)
+        select = geometry.to_data(select, substruct=self.state.select_substruct)
 
-            select = iter_array_updated[select]
-            subset_state = CategorySubsetState(self.state.layers_data[0].components[0], select)
+        data = self.state.layers_data[0]
+        dfile = dendro_file(data)
 
-            self.apply_subset_state(subset_state)
+        if dfile is not None:
+            # astrodendro trees select their structures, which the linked
+            # image looks up in its pixel index
+            subset_state = StructureSubsetState(dfile, data['structure'][select])
         else:
-            raise TypeError("Only PointROI selections are supported")
+            subset_state = CategorySubsetState(data.components[0], select)
+
+        self.apply_subset_state(subset_state)
 
 
     @staticmethod
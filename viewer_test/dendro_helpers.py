@@ -8,248 +8,701 @@ Notes.
 '''
 
 
-def dendro_layout(parent, height, orientation='bottom-up'):
+def dendro_layout(parent, height, orientation='bottom-up', placement='mean'):
     '''
     Calculates the line coordinates.
 
     The function wraps around several other functions in this file.
+    `placement` sets how branches are placed above their children (see
+    `calculate_xpos`).
     '''
 
     # calculate leafness (needed as input below)
-    leafness = calculate_leafness(parent)
+    is_leaf = calculate_is_leaf(parent)
     # calculate children (needed as input below)
-    children = calculate_children(parent, leafness)
+    children = calculate_children_index(parent)
 
     # calculate the x-position
-    xpos = calculate_xpos(parent, leafness, children)
-    # calculate the list of coordinates that can be used by LineCollection
-    verts, verts_horiz = calculate_verts(parent, height, leafness, xpos,
-                                         orientation=orientation)
+    xpos = calculate_xpos(parent, is_leaf, children, placement=placement)
+    # calculate the array of coordinates that can be used by LineCollection
+    verts = calculate_verts(parent, height, is_leaf, xpos,
+                            children, orientation=orientation)
 
+    return verts
 
-    return verts, verts_horiz
 
-
-def calculate_leafness(parent):
+def calculate_is_leaf(parent):
     '''
-    Calculates whether structures are leaves or branches.
+    Calculates whether structures are leaves (True) or branches (False).
+
+    A structure is a leaf if no structure has it as its parent, so this
+    works for any ordering of the parent array.
     '''
 
-    leafness = []
+    parent = np.asarray(parent, dtype=int)
 
-    for idx in range(len(parent)):
-        # A structure is a leaf if its parent has an id (index)
-        # larger than the parent of the next structure.
-        if idx != (len(parent) - 1):
+    return np.bincount(parent[parent >= 0], minlength=len(parent)) == 0
 
-            leafness.append('leaf' if (parent[idx] >= parent[idx + 1]) else 'branch')
 
-        else:
-            ## The last structure is always a leaf.
-            leafness.append('leaf')
+def calculate_leafness(parent):
+    '''
+    Calculates whether structures are leaves or branches, as a list of
+    'leaf' and 'branch' strings (see `calculate_is_leaf`).
+    '''
 
-    return leafness
+    return np.where(calculate_is_leaf(parent), 'leaf', 'branch').tolist()
 
 
 def calculate_nleaf(parent):
     '''
     Calculate the total number of leaves.
+    '''
+
+    return int(np.sum(calculate_is_leaf(parent)))
 
-    The result is used for looping through the leaves in the calculation of
-    the x-positions.
+
+def calculate_children_index(parent):
+    '''
+    Calculate the (direct) children of each structure as a CSR-style index.
+
+    The children of structure `idx` are `child_ids[offsets[idx]:offsets[idx + 1]]`,
+    in the order in which they appear in the parent array.
     '''
 
-    leafness = calculate_leafness(parent)
-    leafness = np.asarray(leafness)
+    parent = np.asarray(parent, dtype=int)
+
+    counts = np.bincount(parent[parent >= 0], minlength=len(parent))
+    offsets = np.zeros(len(parent) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    # a stable sort keeps siblings in their original order; the roots
+    # (parent -1) end up in front and are skipped
+    child_ids = np.argsort(parent, kind='stable')[np.sum(parent < 0):]
 
-    return np.sum(leafness == 'leaf')
+    return offsets, child_ids
 
 
-def calculate_children(parent, leafness):
+def is_preorder(parent, children=None):
     '''
-    Calculate the (direct) children of each structure.
+    Whether the parent array is in preorder, with every subtree contiguous
+    and the children of each structure (and the roots of a forest) in the
+    order of their ids.
+
+    This holds if the first child of every branch comes right after it
+    and every other child (or root) right after the subtree of its previous
+    sibling, which is checked for all structures at once.
     '''
 
-    children = []
+    parent = np.asarray(parent, dtype=int)
 
-    iter_array = np.array(range(len(parent)))
+    if len(parent) == 0:
+        return True
 
-    for idx in iter_array:
-        # Does the calculation only for the branches.
-        if leafness[idx] == 'branch':
-            child = iter_array[(parent == idx)]
-        else:
-            child = np.array([])
+    ids = np.arange(len(parent))
+    if np.any(parent >= ids) or parent[0] >= 0:
+        return False
+
+    if children is None:
+        children = calculate_children_index(parent)
+
+    offsets, child_ids = children
+    end = calculate_subtree_extent(parent, children=children)[1]
 
-        children.append(child)
+    branches = np.nonzero(offsets[1:] > offsets[:-1])[0]
+    if np.any(child_ids[offsets[branches]] != branches + 1):
+        return False
 
-    return children
+    # each root follows the tree of the previous root
+    roots = np.nonzero(parent < 0)[0]
+    if np.any(end[roots[:-1]] != roots[1:]):
+        return False
 
+    # siblings follow each other; the last child of a group is followed by
+    # the first child of another parent, which is not a sibling
+    sibling = parent[child_ids[1:]] == parent[child_ids[:-1]]
+    return bool(np.all(end[child_ids[:-1]][sibling] == child_ids[1:][sibling]))
 
-def calculate_subtree(parent, leafness):
+
+def preorder_permutation(parent, children=None):
     '''
-    Calculate the full subtree of each structure.
+    Reorders any parent array (e.g. from a CSV table or a catalog, in any
+    row order) into preorder, with every subtree contiguous.
 
-    The output is used for sorting to move subtrees together with their parents.
+    The tree is walked by an iterative depth-first search over the children
+    index, visiting the children of each structure in the order of their
+    ids (and the roots likewise). Returns `order` (the original id of each
+    preorder position), its inverse and the parent array in preorder.
     '''
 
-    subtree = []
-    iter_array = np.array(range(len(parent)))
-    nlevels = len(set(parent))
+    parent = np.asarray(parent, dtype=int)
 
-    for idx in iter_array:
-        if leafness[idx] == 'branch':
-            parent_own = parent[idx]
-            if sum(parent == parent_own) == 1.:
-                descendent = iter_array[1:]
-            else:
-                if sum((parent <= parent_own) & (iter_array > idx)) == 0.:
-                    descendent = iter_array[(idx + 1):]
-                else:
-                    descendent = iter_array[(idx + 1):
-                                            iter_array[np.where((parent <= parent_own) & (iter_array > idx))][0]]
-        else:
-            descendent = np.array([])
+    if children is None:
+        children = calculate_children_index(parent)
+
+    if is_preorder(parent, children=children):
+        order = np.arange(len(parent))
+        return order, order.copy(), parent
+
+    offsets, child_ids = children
+    offsets = offsets.tolist()
+    child_ids = child_ids.tolist()
+
+    order = []
+    stack = np.nonzero(parent < 0)[0][::-1].tolist()
+
+    while stack:
+        idx = stack.pop()
+        order.append(idx)
+        # pushed in reverse, so that the first child is visited first
+        stack.extend(child_ids[offsets[idx]:offsets[idx + 1]][::-1])
+
+    if len(order) != len(parent):
+        raise ValueError("The parent array does not describe a tree "
+                         "(some structures are not connected to a root)")
+
+    order = np.array(order, dtype=int)
+    inverse, parent_preorder = permute_parent(parent, order)
+
+    return order, inverse, parent_preorder
+
+
+def permute_parent(parent, order):
+    '''
+    The inverse of the permutation `order`, and the parent array in this
+    order (with the parent ids renumbered). The parent array itself is
+    returned if `order` is the identity.
+    '''
+
+    inverse = np.empty(len(order), dtype=int)
+    inverse[order] = np.arange(len(order))
+
+    if np.all(inverse == np.arange(len(order))):
+        return inverse, parent
+
+    parent = parent[order]
+    has_parent = parent >= 0
+    parent[has_parent] = inverse[parent[has_parent]]
+
+    return inverse, parent
 
-        subtree.append(descendent)
 
-    return subtree
+def calculate_subtree_extent(parent, children=None):
+    '''
+    Calculate the extent of the subtree of each structure.
+
+    In a preorder parent array every subtree is contiguous: the descendants
+    of structure `idx` are `start[idx]:end[idx]`, with `start = idx + 1`.
+    The last descendant is found by following the last-child links, which
+    is done for all structures at once by pointer jumping.
+    '''
+
+    if children is None:
+        children = calculate_children_index(parent)
+
+    offsets, child_ids = children
+
+    iter_array = np.arange(len(parent))
+
+    last = iter_array.copy()
+    is_branch = offsets[1:] > offsets[:-1]
+    last[is_branch] = child_ids[offsets[1:][is_branch] - 1]
+
+    active = np.nonzero(last[last] != last)[0]
+    while len(active) > 0:
+        last[active] = last[last[active]]
+        active = active[last[last[active]] != last[active]]
+
+    return iter_array + 1, last + 1
 
 
-def calculate_xpos(parent, leafness, children):
+class SubtreeIndex(object):
+    '''
+    Index of the subtrees of a preorder parent array.
+
+    The output is used for sorting to move subtrees together with their
+    parents, and for extending selections to substructures.
+    '''
+
+    def __init__(self, parent, children=None):
+        self.start, self.end = calculate_subtree_extent(parent, children=children)
+        self._ids = np.arange(len(parent))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def descendants(self, idx):
+        '''
+        The descendants of structure `idx` (a view, not a copy).
+        '''
+        return self._ids[self.start[idx]:self.end[idx]]
+
+    def expand(self, select):
+        '''
+        The sorted ids of the selected structures and all their descendants.
+        '''
+
+        select = np.asarray(select, dtype=int)
+
+        # +1 where a selected subtree starts and -1 where it ends
+        depth = np.zeros(len(self._ids) + 1, dtype=int)
+        np.add.at(depth, select, 1)
+        np.add.at(depth, self.end[select], -1)
+
+        return self._ids[np.cumsum(depth[:-1]) > 0]
+
+
+def calculate_leaf_count(parent, children=None):
+    '''
+    Calculate the number of leaves in the subtree of each structure (a
+    leaf counts itself).
+
+    The output can be used as a key to sort structures by their size.
+    '''
+
+    if children is None:
+        children = calculate_children_index(parent)
+
+    offsets = children[0]
+    subtree = SubtreeIndex(parent, children=children)
+
+    nleaf_before = np.zeros(len(parent) + 1, dtype=int)
+    np.cumsum(offsets[1:] == offsets[:-1], out=nleaf_before[1:])
+
+    return nleaf_before[subtree.end] - nleaf_before[:-1]
+
+
+def reduce_ranges(ufunc, values, start, end):
+    '''
+    Reduce `values` with `ufunc` (e.g. np.fmax) over each of the sorted,
+    non-overlapping and non-empty ranges [start, end), in one reduceat.
+
+    Only the part of `values` between the first and the last range is read.
+    '''
+
+    if len(start) == 0:
+        return np.zeros(0, dtype=np.asarray(values).dtype)
+
+    bounds = np.empty(2 * len(start), dtype=int)
+    bounds[0::2] = start
+    bounds[1::2] = end
+
+    # the gaps between the ranges are reduced too, and skipped; the last
+    # range runs to the end of the slice
+    values = values[bounds[0]:bounds[-1]]
+    return ufunc.reduceat(values, bounds[:-1] - bounds[0])[0::2]
+
+
+def collapse_subtrees(parent, leaf_count, subtree, max_leaves, ids):
+    '''
+    Find the subtrees to collapse when drawing a tree at a coarse level of
+    detail.
+
+    A branch is collapsed if its subtree has no more than `max_leaves`
+    leaves (and its parent is not collapsed already). Only the structures
+    `ids` are looked at: returns the mask of those left visible (collapsed
+    branches included) and the mask of the collapsed ones.
+    '''
+
+    parent = np.asarray(parent, dtype=int)
+
+    def collapsible(idx):
+        return (subtree.end[idx] > subtree.start[idx]) & (leaf_count[idx] <= max_leaves)
+
+    # leaf counts grow towards the root, so a structure is inside a
+    # collapsed subtree exactly when its parent is collapsible
+    par = parent[ids]
+    visible = ~((par >= 0) & collapsible(np.maximum(par, 0)))
+    collapsed = visible & collapsible(ids)
+
+    return visible, collapsed
+
+def calculate_xpos(parent, is_leaf, children, placement='mean'):
     '''
     Calculate the x-positions of the structures.
 
+    The leaves are placed at 1, 2, 3, ... in the order of the parent array.
+    Each branch is then placed exactly once, in a single bottom-up pass,
+    according to `placement`:
+
+    * 'mean': the mean of its direct children (default)
+    * 'midpoint': midway between its first and last child
+    * 'leaves': the mean of all the leaves below it
+    * 'first' / 'last': above its first / last child
+
     The output from this function is used to calculate the coordinates of the line segments.
     '''
 
+    if placement not in ('mean', 'midpoint', 'leaves', 'first', 'last'):
+        raise ValueError("Unknown placement: {0}".format(placement))
 
-    x_pos = np.zeros(len(parent))
-    iter_array = np.array(range(len(parent)))
+    is_leaf = np.asarray(is_leaf, dtype=bool)
 
     # leaves
-    _cached_pos = 1.
-    for idx in iter_array[(np.array(leafness) == 'leaf')]:
-        x_pos[idx] = _cached_pos
-        _cached_pos += 1.
+    x_pos = np.zeros(len(parent))
+    x_pos[is_leaf] = np.arange(1., np.sum(is_leaf) + 1.)
 
     # branches
-    # nlevels = 5
+    # Children always come after their parent in the (preorder) parent
+    # array, so walking it backwards is a postorder traversal.  Plain lists
+    # are used here since indexing them is much faster than numpy scalars.
+    offsets, child_ids = children
+    x_list = x_pos.tolist()
+    offsets = offsets.tolist()
+    child_ids = child_ids.tolist()
+
+    # the sum of the x-positions and the number of leaves below each structure
+    leaf_sum = list(x_list)
+    leaf_count = is_leaf.astype(float).tolist()
 
-    nlevels = len(set(parent))  # optimize this
+    for idx in range(len(parent) - 1, -1, -1):
 
-    for level in np.array(range(nlevels)):
-        for idx in iter_array[(np.array(leafness) == 'branch')]:
+        start, stop = offsets[idx], offsets[idx + 1]
 
-            if x_pos[idx] == 0.:
-                if np.all(x_pos[children[idx]] != 0.):
-                    x_pos[idx] = np.mean(x_pos[children[idx]])
-                else:
-                    continue
-            else:
-                continue
+        if start == stop:
+            continue
 
-    return x_pos
+        child = child_ids[start:stop]
 
+        if placement == 'mean':
+            x_list[idx] = sum([x_list[c] for c in child]) / len(child)
+        elif placement == 'midpoint':
+            x_list[idx] = 0.5 * (x_list[child[0]] + x_list[child[-1]])
+        elif placement == 'first':
+            x_list[idx] = x_list[child[0]]
+        elif placement == 'last':
+            x_list[idx] = x_list[child[-1]]
+        else:
+            leaf_sum[idx] = sum([leaf_sum[c] for c in child])
+            leaf_count[idx] = sum([leaf_count[c] for c in child])
+            x_list[idx] = leaf_sum[idx] / leaf_count[idx]
 
-def calculate_verts(parent, height, leafness, x_pos, orientation='bottom-up'):
+    return np.array(x_list)
+
+
+def calculate_verts(parent, height, is_leaf, x_pos, children, orientation='bottom-up'):
     '''
     Calculate the coordinates of the line segments used by LineCollection.
 
-    The output is a list of 2 by 2 array, corresponding to the starting and end points.
+    The output is a single (n_segments, 2, 2) array with the starting and end
+    points of each segment: first the vertical line of every structure (in
+    the order of the parent array), then the horizontal line of every branch.
+    For the left-right and right-left orientations the two axes are swapped
+    in a view of the same array (see `orient_verts`).
     '''
 
-    verts = []
-    iter_array = np.array(range(len(parent)))
+    parent = np.asarray(parent, dtype=int)
+    height = np.asarray(height, dtype=float)
+    offsets, child_ids = children
+
+    branches = np.nonzero(~np.asarray(is_leaf, dtype=bool))[0]
+    nstruct = len(parent)
+
+    verts = np.empty((nstruct + len(branches), 2, 2))
 
     # vertices for vertical lines
-    for idx in iter_array:
-        if parent[idx] == -1:
-            vert = np.array([[x_pos[idx], 0.],
-                             [x_pos[idx], height[idx]]])
-        else:
-            vert = np.array([[x_pos[idx], height[parent[idx]]],
-                             [x_pos[idx], height[idx]]])
+    verts[:nstruct, :, 0] = x_pos[:, np.newaxis]
+    verts[:nstruct, 0, 1] = np.where(parent >= 0, height[parent], 0.)
+    verts[:nstruct, 1, 1] = height
 
-        verts.append(vert)
+    # vertices for horizontal lines, from the first to the last child
+    verts[nstruct:, 0, 0] = x_pos[child_ids[offsets[branches]]]
+    verts[nstruct:, 1, 0] = x_pos[child_ids[offsets[branches + 1] - 1]]
+    verts[nstruct:, :, 1] = height[branches, np.newaxis]
+
+    return orient_verts(verts, orientation)
+
+
+def orient_verts(verts, orientation):
+    '''
+    The bottom-up line segments from `calculate_verts` in another orientation.
 
-    verts_horiz = []
+    The left-right and right-left orientations swap the two axes, which is a
+    view of the same array; top-down and right-left only differ from
+    bottom-up and left-right by the direction of the axis limits.
+    '''
+
+    if (orientation == 'left-right') or (orientation == 'right-left'):
+        return verts[:, :, ::-1]
+
+    return verts
+
+
+class SelectionGeometry(object):
+    '''
+    The positions of the vertical lines of a sorted tree, used to find the
+    structures selected by an ROI.
+
+    Queries are in the coordinates of the bottom-up layout (`x` along the
+    leaves, `y` along the heights); the viewer swaps the ROI coordinates for
+    the left-right and right-left orientations. Queries return ids in the
+    sorted order, and `to_data` maps them back to ids in the data.
+    '''
 
-    # vertices for horizontal lines
-    for idx in iter_array:
-        if leafness[idx] == 'branch':
-            vert = np.array([[x_pos[iter_array[(parent == idx)][0]], height[idx]],
-                             [x_pos[iter_array[(parent == idx)][-1]], height[idx]]])
+    def __init__(self, parent, height, x_pos, order, children=None, x_order=None):
+
+        parent = np.asarray(parent, dtype=int)
+
+        self.x = np.asarray(x_pos, dtype=float)
+        self.y = np.asarray(height, dtype=float)
+        # the vertical line of a structure starts at the height of its
+        # parent (the root only spans its own height)
+        self.parent_y = np.where(parent >= 0, self.y[parent], self.y)
+        self.order = np.asarray(order, dtype=int)
+        self.subtree = SubtreeIndex(parent, children=children)
+
+        # sorted indices over the x-positions and the tops of the lines, so
+        # that queries only look at the lines in a window of either
+        if x_order is None:
+            x_order = np.argsort(self.x, kind='stable')
+        self._x_order = x_order
+        self._x_sorted = self.x[self._x_order]
+        self._y_order = np.argsort(self.y, kind='stable')
+        self._y_sorted = self.y[self._y_order]
+
+    def __len__(self):
+        return len(self.x)
+
+    def _spans(self, ids, ymin, ymax):
+        # whether the lines of `ids` overlap the heights [ymin, ymax]
+        return (self.y[ids] >= ymin) & (self.parent_y[ids] <= ymax)
+
+    def pick(self, x, y, window=16):
+        '''
+        The structure whose vertical line is closest to `x` at height `y`
+        (an empty array if no line spans `y`).
+
+        The search starts with the `window` lines on either side of `x` and
+        widens until no line outside the window can be closer. Ties go to
+        the lowest id.
+        '''
+
+        n = len(self.x)
+        pos = np.searchsorted(self._x_sorted, x)
+
+        while True:
+
+            lo, hi = max(pos - window, 0), min(pos + window, n)
+
+            ids = self._x_order[lo:hi]
+            ids = ids[self._spans(ids, y, y)]
+
+            if len(ids) > 0:
+                delt = np.abs(x - self.x[ids])
+                best = ids[delt == delt.min()].min()
+                # lines outside the window are at least this far away
+                reach = min(x - self._x_sorted[lo - 1] if lo > 0 else np.inf,
+                            self._x_sorted[hi] - x if hi < n else np.inf)
+                if delt.min() < reach:
+                    return np.array([best])
+
+            if lo == 0 and hi == n:
+                if len(ids) > 0:
+                    return np.array([best])
+                return np.array([], dtype=int)
+
+            window *= 4
+
+    def select(self, xmin=-np.inf, xmax=np.inf, ymin=-np.inf, ymax=np.inf):
+        '''
+        The structures whose vertical line overlaps the given box.
+
+        Only the lines in the x-range, or the lines reaching above `ymin`,
+        are tested (whichever is fewer).
+        '''
+
+        xlo = np.searchsorted(self._x_sorted, xmin, side='left')
+        xhi = np.searchsorted(self._x_sorted, xmax, side='right')
+        ylo = np.searchsorted(self._y_sorted, ymin, side='left')
+
+        if xhi - xlo <= len(self.y) - ylo:
+            ids = self._x_order[xlo:xhi]
+            ids = ids[self._spans(ids, ymin, ymax)]
         else:
-            continue
+            ids = self._y_order[ylo:]
+            ids = ids[(self.x[ids] >= xmin) & (self.x[ids] <= xmax) &
+                      (self.parent_y[ids] <= ymax)]
+
+        return np.sort(ids)
+
+    def to_data(self, select, substruct=False):
+        '''
+        Convert the selected (sorted) ids to ids in the data, optionally
+        adding all the substructures of the selected structures.
+        '''
+
+        select = np.asarray(select, dtype=int)
+
+        if substruct:
+            select = self.subtree.expand(select)
+
+        return self.order[select]
+
+    def select_roi(self, kind, bounds, sideways=False):
+        '''
+        The structures selected by a ROI drawn in the viewer: a 'point'
+        (x, y), a 'rectangle' (xmin, xmax, ymin, ymax), or an 'xrange' or
+        'yrange' (min, max), in the axes of the viewer.
+
+        For the sideways (left-right and right-left) orientations the
+        heights are on the x-axis, so the axes are swapped back to those of
+        the bottom-up layout.
+        '''
+
+        if kind == 'point':
+            x, y = bounds
+            return self.pick(y, x) if sideways else self.pick(x, y)
+
+        if kind == 'rectangle':
+            xmin, xmax, ymin, ymax = bounds
+            if sideways:
+                xmin, xmax, ymin, ymax = ymin, ymax, xmin, xmax
+            return self.select(xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+
+        if kind not in ('xrange', 'yrange'):
+            raise ValueError("Unknown ROI: {0}".format(kind))
+
+        vmin, vmax = bounds
+        if (kind == 'xrange') != sideways:
+            return self.select(xmin=vmin, xmax=vmax)
+        return self.select(ymin=vmin, ymax=vmax)
+
+
+def sort_siblings(parent, sortby_array, children, previous=None):
+    '''
+    Sort the children of every structure by `sortby_array`.
+
+    Returns the child ids grouped by parent (as in the CSR children index)
+    and sorted by the key within each group. If `previous` (the output of
+    an earlier call with another key) is given, only the sibling groups
+    that are out of order for the new key are sorted again.
+    '''
 
-        verts_horiz.append(vert)
+    parent = np.asarray(parent, dtype=int)
+    sortby_array = np.asarray(sortby_array)
+    offsets, child_ids = children
 
-    if (orientation == 'bottom-up') or (orientation == 'top-down'):
-        return verts, verts_horiz
-    elif (orientation == 'left-right') or (orientation == 'right-left'):
+    if previous is None:
+        child_parent = parent[child_ids]
+        return child_ids[np.lexsort((sortby_array[child_ids], child_parent))]
 
-        verts_rot = []
+    # ties keep the order of the children index, as in a full sort
+    rank = np.empty(len(parent), dtype=int)
+    rank[child_ids] = np.arange(len(child_ids))
 
-        for vert in verts:
-            _cache = np.zeros(vert.shape)
+    # groups in which a child comes before a sibling it should follow
+    key = sortby_array[previous]
+    child_parent = parent[previous]
+    ahead = (key[1:] < key[:-1]) | ((key[1:] == key[:-1]) &
+                                    (rank[previous[1:]] < rank[previous[:-1]]))
+    unsorted = ahead & (child_parent[1:] == child_parent[:-1])
 
-            _cache[:, 0] = vert[:, 1]
-            _cache[:, 1] = vert[:, 0]
+    if not unsorted.any():
+        return previous
 
-            verts_rot.append(_cache)
+    resort = np.zeros(len(parent), dtype=bool)
+    resort[child_parent[1:][unsorted]] = True
+    slots = np.nonzero(resort[child_parent])[0]
 
-        verts_horiz_rot = []
+    # the groups stay in their slots; only their contents are reordered
+    child_ids = previous.copy()
+    moved = previous[slots]
+    child_ids[slots] = moved[np.lexsort((rank[moved], sortby_array[moved], child_parent[slots]))]
 
-        for vert in verts_horiz:
-            _cache = np.zeros(vert.shape)
+    return child_ids
 
-            _cache[:, 0] = vert[:, 1]
-            _cache[:, 1] = vert[:, 0]
 
-            verts_horiz_rot.append(_cache)
+def sort_tree(parent, sortby_array, children=None, subtree=None, sorted_children=None):
+    '''
+    Reorders the structures so that the children of every structure are
+    sorted by `sortby_array` (e.g. height, a property or the leaf count),
+    keeping every subtree contiguous and in preorder.
+
+    Siblings are sorted in one stable lexsort over the CSR children index
+    (see `sort_siblings`, whose output can be passed as `sorted_children`).
+    The new position of a child is then its parent's position plus one plus
+    the sizes of the subtrees of its preceding siblings, which is summed down
+    from the root for all structures at once. The roots of a forest are
+    treated as the children of a virtual root, in the order of their ids.
+
+    Returns `order` (the old id of each new position), its inverse (the new
+    position of each old id) and the parent array in the new order.
+    '''
+
+    parent = np.asarray(parent, dtype=int)
+
+    if children is None:
+        children = calculate_children_index(parent)
+    if subtree is None:
+        subtree = SubtreeIndex(parent, children=children)
+
+    offsets = children[0]
+    size = subtree.end - subtree.start + 1
+
+    # children grouped by parent, sorted by the key within each group
+    if sorted_children is None:
+        sorted_children = sort_siblings(parent, sortby_array, children)
+    child_ids = sorted_children
+    child_parent = parent[child_ids]
+
+    # offset of each child from its parent: one plus the sizes of the
+    # subtrees of the preceding siblings
+    preceding = np.cumsum(size[child_ids]) - size[child_ids]
+    relative = np.zeros(len(parent))
+    relative[child_ids] = 1 + preceding - preceding[offsets[child_parent]]
+    # the roots start after the trees of the previous roots
+    roots = np.nonzero(parent < 0)[0]
+    relative[roots] = np.cumsum(size[roots]) - size[roots]
+
+    # summing the offsets from the root gives the new positions
+    inverse = compute_heights(parent, relative).astype(int)
+
+    order = np.empty(len(parent), dtype=int)
+    order[inverse] = np.arange(len(parent))
 
-        return verts_rot, verts_horiz_rot
+    parent_sorted = parent[order]
+    parent_sorted[parent_sorted >= 0] = inverse[parent_sorted[parent_sorted >= 0]]
+
+    return order, inverse, parent_sorted
 
 
 def sort1Darrays(parent, height, sortby_array):
     '''
     Sorts array according to `sortby_array`.
+
+    Returns the sorted parent and height arrays, and the original id of
+    each sorted structure.
     '''
 
     if sortby_array is None:
-        return parent, height
-
-    leafness = calculate_leafness(parent)
-    subtree = calculate_subtree(parent, leafness)
-
-    iter_array = np.array(range(len(parent)))
+        return parent, height, np.arange(len(parent))
 
-    iter_array_updated = iter_array.copy()
-    parent_updated = parent.copy()
+    order, inverse, parent_updated = sort_tree(parent, sortby_array)
+    height_updated = np.asarray(height)[order]
 
-    for idx in iter_array:
+    return parent_updated, height_updated, order
 
-        if sum(parent == idx) > 0.:
-            args_0 = iter_array[parent == idx]
-            sortby = sortby_array[parent == idx]
-            args_sorted = args_0[np.argsort(sortby)]
 
-            idx_j = np.where(iter_array_updated == idx)[0][0]
+def compute_heights(parent, length):
+    '''
+    Calculate the height of each structure as the cumulative branch length
+    from the root.
+
+    Works for any ordering of the parent array (not only preorder).  The
+    path sums are accumulated by pointer jumping: each pass adds the
+    partial sum of the current ancestor and then skips to that ancestor's
+    ancestor, so the loop runs log2(depth) vectorized passes over the arrays.
+    Missing (NaN) branch lengths count as zero.
+    '''
 
-            for jdx in args_sorted:
-                iter_array_updated[(idx_j + 1)] = jdx
-                parent_updated[(idx_j + 1)] = np.where(iter_array_updated == idx)[0][0]
+    parent = np.asarray(parent, dtype=int)
+    heights = np.nan_to_num(np.asarray(length, dtype=float))
 
-                descendent = subtree[jdx]
-                if len(descendent) > 0.:
-                    iter_array_updated[(idx_j + 2):(idx_j + 2 + len(descendent))] = descendent
-                    parent_updated[(idx_j + 2):(idx_j + 2 + len(descendent))] = parent[descendent] + ((idx_j + 1) - jdx)
-                idx_j = idx_j + (1 + len(descendent))
-        else:
-            continue
+    ancestor = parent.copy()
+    active = np.nonzero(ancestor >= 0)[0]
 
-    # parent_updated = parent[iter_array_updated]
-    height_updated = height[np.asarray(iter_array_updated, dtype = np.int)]
+    while len(active) > 0:
+        heights[active] += heights[ancestor[active]]
+        ancestor[active] = ancestor[ancestor[active]]
+        active = active[ancestor[active] >= 0]
 
-    return parent_updated, height_updated, iter_array_updated
+    return heights
@@ -0,0 +1,472 @@
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import matplotlib.colors as mplcolors
+
+from dendro_helpers import (sort_siblings, sort_tree, calculate_is_leaf, calculate_children_index,
+                            preorder_permutation, permute_parent,
+                            calculate_xpos, calculate_verts, calculate_leaf_count,
+                            collapse_subtrees, reduce_ranges, SubtreeIndex,
+                            SelectionGeometry)
+
+'''
+Notes.
+* The layouts are shared by all the layer artists (in all the viewers)
+  that show the same data, so that restyling a layer or adding a subset
+  layer does not recompute the layout.
+* The layouts are computed in a background thread, so that the viewers
+  stay responsive while large trees are laid out.
+'''
+
+
+class TreeTopology(object):
+    '''
+    The structure of the tree, shared by all the sort keys and heights.
+
+    The tree is normalized to preorder (every subtree contiguous), which
+    the layout relies on; `order` gives the row of the data for each
+    structure of the normalized tree and `inverse` the other way around.
+    Both are the identity for data that is already in preorder, like the
+    astrodendro and newick files.
+
+    `saved` are the arrays of `layout_arrays` saved for the same tree, which
+    replace the normalization.
+    '''
+
+    def __init__(self, parent, saved=None):
+        parent = np.asarray(parent, dtype=int)
+        children = calculate_children_index(parent)
+        if saved is None:
+            self.order, self.inverse, self.parent = preorder_permutation(parent, children=children)
+        else:
+            self.order = saved['order']
+            self.inverse, self.parent = permute_parent(parent, self.order)
+        if self.parent is not parent:
+            children = calculate_children_index(self.parent)
+        self.children = children
+        self.subtree = SubtreeIndex(self.parent, children=self.children)
+        self.is_leaf = calculate_is_leaf(self.parent)
+
+    def layout_arrays(self):
+        # what the topology is rebuilt from (see `saved`)
+        return {'order': self.order}
+
+
+class SortedTree(object):
+    '''
+    The tree sorted by one key, and everything about its layout that does
+    not depend on the heights: the children and subtrees in the sorted
+    order, the leaf order and the x-positions.
+
+    If `previous` (a SortedTree of the same topology with another key) is
+    given, only the sibling groups that the new key reorders are sorted
+    again, and everything is shared with `previous` if there are none.
+
+    `saved` are the arrays of `layout_arrays` saved for the same topology
+    and key, from which the tree is rebuilt without sorting it or placing
+    its structures again.
+    '''
+
+    def __init__(self, topology, sortby_array, previous=None, saved=None):
+
+        self.topology = topology
+
+        if saved is not None:
+            self.siblings = saved['siblings']
+            order = topology.inverse[saved['order']]
+            self.parent = permute_parent(topology.parent, order)[1]
+            self.children = calculate_children_index(self.parent)
+            self._set_layout(order, saved['xpos'])
+            return
+
+        if sortby_array is None:
+            self.siblings = topology.children[1]
+        else:
+            sortby_array = np.asarray(sortby_array)[topology.order]
+            self.siblings = sort_siblings(topology.parent, sortby_array, topology.children,
+                                          previous=None if previous is None else previous.siblings)
+
+        if previous is not None and self.siblings is previous.siblings:
+            self.__dict__.update((k, v) for k, v in previous.__dict__.items()
+                                 if k not in ('topology', 'siblings'))
+            return
+
+        if sortby_array is None:
+            order = np.arange(len(topology.parent))
+            self.parent = topology.parent
+            self.children = topology.children
+        else:
+            order, _, self.parent = sort_tree(topology.parent, sortby_array,
+                                              children=topology.children,
+                                              subtree=topology.subtree,
+                                              sorted_children=self.siblings)
+            self.children = calculate_children_index(self.parent)
+
+        self._set_layout(order)
+
+    def _set_layout(self, order, xpos=None):
+        # everything else, from the order of the structures in the preorder
+        # of the topology
+        topology = self.topology
+
+        # leaves stay leaves whatever the order
+        self.is_leaf = topology.is_leaf[order]
+        # rows of the data, through the preorder of the topology
+        self.order = topology.order[order]
+        if xpos is None:
+            xpos = calculate_xpos(self.parent, self.is_leaf, self.children)
+        self.xpos = xpos
+        self.nleaf = int(np.sum(self.is_leaf))
+
+        # the horizontal lines are those of the branches, in this order
+        self.branches = np.nonzero(~self.is_leaf)[0]
+        # position of each structure of the data in the sorted arrays
+        self.inverse = np.empty(len(self.order), dtype=int)
+        self.inverse[self.order] = np.arange(len(self.order))
+        # segment of the horizontal line of each branch (-1 for leaves)
+        self.horiz_index = np.full(len(self.parent), -1, dtype=int)
+        self.horiz_index[self.branches] = len(self.parent) + np.arange(len(self.branches))
+        self.leaves = np.nonzero(self.is_leaf)[0]
+
+        self._subtree = None
+        self._leaf_count = None
+        self._x_order = None
+
+    def layout_arrays(self):
+        # what the tree is rebuilt from (see `saved`)
+        return {'siblings': self.siblings,
+                'order': self.order,
+                'xpos': self.xpos}
+
+    @property
+    def x_order(self):
+        # the structures sorted by x-position, for the selection geometry
+        if self._x_order is None:
+            self._x_order = np.argsort(self.xpos, kind='stable')
+        return self._x_order
+
+    @property
+    def subtree(self):
+        if self._subtree is None:
+            self._subtree = SubtreeIndex(self.parent, children=self.children)
+        return self._subtree
+
+    @property
+    def leaf_count(self):
+        if self._leaf_count is None:
+            self._leaf_count = calculate_leaf_count(self.parent, children=self.children)
+        return self._leaf_count
+
+
+class TreeLayout(object):
+    '''
+    The line segments of a sorted tree for one height attribute.
+
+    Only the y-coordinates are computed here; everything else comes from
+    the SortedTree, which is shared by the layouts of all the heights.
+    '''
+
+    # shared with the sorted tree
+    _shared = ('order', 'parent', 'children', 'xpos', 'nleaf', 'branches',
+               'inverse', 'horiz_index', 'leaves')
+
+    def __init__(self, tree, height):
+
+        self.tree = tree
+        for name in self._shared:
+            setattr(self, name, getattr(tree, name))
+
+        self.height = np.asarray(height, dtype=float)[self.order]
+
+        # the segments of the bottom-up orientation; the other orientations
+        # are views of them (see orient_verts)
+        self.verts = calculate_verts(self.parent, self.height, tree.is_leaf, self.xpos,
+                                     self.children)
+
+        # extent of the segments in the coordinates of the bottom-up layout
+        self.height_range = (np.nanmin(self.height), np.nanmax(self.height))
+        self.extent = (np.min(self.xpos), np.max(self.xpos),
+                       min(0., self.height_range[0]), self.height_range[1])
+
+        self._geometry = None
+
+    def colors(self, values, cmap, vmin, vmax):
+        '''
+        RGBA colors of all the segments in the Linear cmap mode: the
+        vertical line of each structure is colored by its value in `values`
+        (in the order of the data), and the horizontal lines are black.
+        '''
+
+        normalize = mplcolors.Normalize(vmin, vmax)
+
+        nstruct = len(self.order)
+        colors = np.zeros((len(self.verts), 4))
+        colors[:nstruct] = cmap(normalize(np.asarray(values)[self.order]))
+        colors[nstruct:, 3] = 1.
+
+        return colors
+
+    @property
+    def verts_horiz(self):
+        # the horizontal lines follow the vertical line of every structure
+        return self.verts[len(self.parent):]
+
+    def selected(self, ids):
+        '''
+        Boolean mask over the sorted structures of the structures `ids`
+        (ids in the data).
+        '''
+
+        selected = np.zeros(len(self.order), dtype=bool)
+        selected[self.inverse[np.asarray(ids, dtype=int)]] = True
+
+        return selected
+
+    def _window_ids(self, xmin, xmax):
+        # the structures that can have a segment in the x-range: those
+        # placed in it, their parents (horizontal lines ending in it) and
+        # the ancestors of the leaf at xmin (horizontal lines across it)
+        ids = self.geometry.select(xmin=xmin, xmax=xmax)
+
+        leaf = self.leaves[int(np.clip(np.floor(xmin), 1, self.nleaf)) - 1]
+        ancestors = []
+        while leaf >= 0:
+            ancestors.append(leaf)
+            leaf = self.parent[leaf]
+
+        ids = np.concatenate([ids, self.parent[ids], ancestors]).astype(int)
+        ids = np.sort(ids[ids >= 0])
+
+        return ids[np.concatenate([[True], ids[1:] != ids[:-1]])]
+
+    def segments(self, max_leaves=None, selected=None, window=None):
+        '''
+        The line segments to draw, as segment ids (into `verts`) and their
+        coordinates.
+
+        * `max_leaves`: draw at a coarse level of detail, in which every
+          subtree with no more than `max_leaves` leaves is drawn as the
+          vertical line of its root, extended up to the highest structure
+          in the subtree.
+        * `selected`: only draw the selected structures (a boolean mask over
+          the sorted structures); a collapsed subtree is drawn if any of its
+          structures is selected.
+        * `window`: only draw the segments crossing (xmin, xmax, ymin, ymax),
+          in the coordinates of the bottom-up layout. Only the structures
+          near the window are looked at, so a zoomed-in view costs in
+          proportion to what it shows.
+        '''
+
+        nstruct = len(self.parent)
+
+        if window is not None:
+            xmin, xmax, ymin, ymax = window
+            ids = self._window_ids(xmin, xmax)
+        else:
+            ids = np.arange(nstruct)
+
+        collapsed = np.zeros(len(ids), dtype=bool)
+
+        if max_leaves is not None:
+            visible, collapsed = collapse_subtrees(self.parent, self.leaf_count, self.subtree,
+                                                   max_leaves, ids)
+            ids, collapsed = ids[visible], collapsed[visible]
+
+        top = self.height[ids]
+        if collapsed.any():
+            top[collapsed] = reduce_ranges(np.fmax, self.height, ids[collapsed],
+                                           self.subtree.end[ids[collapsed]])
+
+        if selected is not None:
+            shown = selected[ids]
+            if collapsed.any():
+                shown[collapsed] = reduce_ranges(np.logical_or, selected, ids[collapsed],
+                                                 self.subtree.end[ids[collapsed]])
+            ids, collapsed, top = ids[shown], collapsed[shown], top[shown]
+
+        # vertical lines, and horizontal lines (none for collapsed branches)
+        vert = ids
+        horiz = self.horiz_index[ids[~collapsed]]
+        horiz = horiz[horiz >= 0]
+
+        if window is not None:
+            # the heights need not grow from parent to child (e.g. for a
+            # size attribute), so a line may run either way
+            x = self.verts[vert, 0, 0]
+            bottom = self.verts[vert, 0, 1]
+            inside = ((x >= xmin) & (x <= xmax) &
+                      (np.maximum(bottom, top) >= ymin) & (np.minimum(bottom, top) <= ymax))
+            vert, top = vert[inside], top[inside]
+
+            bars = self.verts[horiz]
+            horiz = horiz[(bars[:, 0, 0] <= xmax) & (bars[:, 1, 0] >= xmin) &
+                          (bars[:, 0, 1] >= ymin) & (bars[:, 0, 1] <= ymax)]
+
+        segment_ids = np.concatenate([vert, horiz])
+        verts = self.verts[segment_ids]
+        verts[:len(vert), 1, 1] = top
+
+        return segment_ids, verts
+
+    @property
+    def subtree(self):
+        return self.tree.subtree
+
+    @property
+    def leaf_count(self):
+        return self.tree.leaf_count
+
+    @property
+    def geometry(self):
+        # built on the first selection, then shared by all the ROI types
+        if self._geometry is None:
+            self._geometry = SelectionGeometry(self.parent, self.height, self.xpos,
+                                               self.order, children=self.children,
+                                               x_order=self.tree.x_order)
+        return self._geometry
+
+
+class TreeLayoutCache(object):
+    '''
+    Cache of the tree layouts of each data, keyed on the attributes and
+    the sort setting (the layouts do not depend on the orientation).
+
+    A cached layout is only reused if the data still returns the very same
+    arrays for the attributes it was calculated from, so that layouts are
+    recomputed when the values of the data change.
+
+    The layouts are built incrementally: the topology of each parent
+    attribute and the sorted tree of each sort key are cached too, so that
+    changing the height attribute only recomputes the y-coordinates, and
+    changing the sort key only re-sorts the sibling groups it reorders.
+
+    The component of the parent attribute may keep the topology and the
+    sorted tree of one key (e.g. in a cache next to its file) as its
+    `layout_store` attribute: an object whose `load_layout()` returns the
+    arrays last given to `save_layout(arrays)`, or None. Every topology and
+    sorted tree computed for it is offered to `save_layout`.
+
+    Layouts are computed in a worker thread. `request` returns a future
+    that is shared by everyone asking for the same layout; `release` gives
+    up on it, and a layout that nobody waits for any more is cancelled if
+    its computation has not started yet.
+    '''
+
+    def __init__(self):
+        self._layouts = weakref.WeakKeyDictionary()
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def request(self, data, x_att, y_att, sort_by):
+
+        parent = data[x_att]
+        height = data[y_att]
+        sortby_array = None if sort_by is None else data[sort_by]
+        store = getattr(data.get_component(x_att), 'layout_store', None)
+
+        # ComponentIDs overload ==, so they are keyed on their identity
+        key = ('layout', id(x_att), id(y_att), sort_by)
+        arrays = (parent, height, sortby_array)
+
+        with self._lock:
+
+            entries = self._layouts.setdefault(data, {})
+
+            if key in entries:
+                cached_arrays, future = entries[key]
+                # failed and cancelled layouts are computed again
+                usable = not future.cancelled() and (not future.done() or
+                                                     future.exception() is None)
+                if usable and all(a is b for a, b in zip(arrays, cached_arrays)):
+                    self._waiting[future] = self._waiting.get(future, 0) + 1
+                    return future
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+
+            future = self._executor.submit(self._compute, entries, id(x_att), sort_by,
+                                           parent, height, sortby_array, store)
+            entries[key] = (arrays, future)
+            self._waiting[future] = 1
+
+        future.add_done_callback(self._on_done)
+
+        return future
+
+    def release(self, future):
+        with self._lock:
+            if future not in self._waiting:
+                return
+            self._waiting[future] -= 1
+            if self._waiting[future] > 0:
+                return
+            del self._waiting[future]
+        # outside of the lock, since cancelling runs the done callbacks
+        future.cancel()
+
+    def get(self, data, x_att, y_att, sort_by):
+        # blocks until the layout is ready (joining any pending computation)
+        future = self.request(data, x_att, y_att, sort_by)
+        try:
+            return future.result()
+        finally:
+            self.release(future)
+
+    def _compute(self, entries, x_key, sort_by, parent, height, sortby_array, store=None):
+        # runs in the worker thread: reuses the cached topology and sorted
+        # tree when their arrays have not changed, or the saved ones
+
+        with self._lock:
+            topology = entries.get(('topology', x_key))
+            tree = entries.get(('sorted', x_key, sort_by))
+            previous = entries.get(('last sorted', x_key))
+
+        saved = None if store is None else store.load_layout()
+        if saved is not None and len(saved['topology']['order']) != len(parent):
+            saved = None
+
+        if topology is None or topology[0] is not parent:
+            if saved is None:
+                topology = (parent, TreeTopology(parent))
+            else:
+                topology = (parent, TreeTopology(parent, saved=saved['topology']))
+        topology = topology[1]
+
+        if (tree is None or tree[0] is not parent or tree[1] is not sortby_array or
+                tree[2].topology is not topology):
+            if previous is not None and previous.topology is not topology:
+                previous = None
+            if saved is not None and saved['sort_by'] == sort_by:
+                tree = SortedTree(topology, sortby_array, saved=saved['sorted'])
+            else:
+                tree = SortedTree(topology, sortby_array, previous=previous)
+                if store is not None:
+                    store.save_layout({'sort_by': sort_by,
+                                       'topology': topology.layout_arrays(),
+                                       'sorted': tree.layout_arrays()})
+            tree = (parent, sortby_array, tree)
+        tree = tree[2]
+
+        with self._lock:
+            entries[('topology', x_key)] = (parent, topology)
+            entries[('sorted', x_key, sort_by)] = (parent, sortby_array, tree)
+            entries[('last sorted', x_key)] = tree
+
+        return TreeLayout(tree, height)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._waiting.pop(future, None)
+
+    def clear(self, data=None):
+        with self._lock:
+            if data is None:
+                self._layouts.clear()
+            else:
+                self._layouts.pop(data, None)
+
+
+LAYOUT_CACHE = TreeLayoutCache()
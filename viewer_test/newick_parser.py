@@ -0,0 +1,287 @@
+import numpy as np
+
+from dendro_helpers import compute_heights
+
+'''
+Notes.
+* The Newick parser of the data factory, which does not need glue (so that
+  it can be used and timed on its own, see benchmarks.py).
+* The files are read as uint8 buffers (usually memory-mapped), and all the
+  structural characters are classified at once with numpy.
+'''
+
+
+# codes of the structural characters of the Newick format
+OPEN, CLOSE, COMMA, COLON, END = 1, 2, 3, 4, 5
+
+NEWICK_EVENTS = np.zeros(256, dtype=np.uint8)
+for _char, _kind in zip(b'(),:;', [OPEN, CLOSE, COMMA, COLON, END]):
+    NEWICK_EVENTS[_char] = _kind
+
+
+def scan_events(buf, chunk_size=2 ** 24):
+    '''
+    Finds the positions and kinds of the structural characters in a byte
+    buffer, up to and including the first ';'.
+
+    The buffer is classified chunk by chunk, so the temporary arrays stay
+    small even when `buf` is a memory-mapped multi-GB file.
+    '''
+
+    positions = []
+    kinds = []
+
+    for offset in range(0, len(buf), chunk_size):
+        chunk = NEWICK_EVENTS[buf[offset:offset + chunk_size]]
+        pos = np.nonzero(chunk)[0]
+        kind = chunk[pos]
+
+        ends = np.nonzero(kind == END)[0]
+        if len(ends) > 0:
+            pos = pos[:ends[0] + 1]
+            kind = kind[:ends[0] + 1]
+
+        positions.append(pos + offset)
+        kinds.append(kind)
+
+        if len(ends) > 0:
+            break
+
+    if len(kinds) == 0 or len(kinds[-1]) == 0 or kinds[-1][-1] != END:
+        # close the tree at the end of the buffer
+        positions.append(np.array([len(buf)]))
+        kinds.append(np.array([END], dtype=np.uint8))
+
+    return np.concatenate(positions), np.concatenate(kinds)
+
+
+def gather_ranges(buf, start, stop, sep, batch_size=2 ** 20):
+    '''
+    Concatenates the byte ranges `buf[start:stop]`, each followed by `sep`.
+    '''
+
+    out = []
+
+    for first in range(0, len(start), batch_size):
+        b_start = start[first:first + batch_size]
+        b_len = stop[first:first + batch_size] - b_start
+        ends = np.cumsum(b_len + 1)
+
+        blob = np.full(ends[-1], sep, dtype=np.uint8)
+        keep = np.ones(ends[-1], dtype=bool)
+        keep[ends - 1] = False
+        dest = np.nonzero(keep)[0]
+        blob[dest] = buf[dest + np.repeat(b_start - (ends - b_len - 1), b_len)]
+
+        out.append(blob.tobytes())
+
+    return b''.join(out)
+
+
+class NewickNames(object):
+    '''
+    Compact string table for the node names.
+
+    Each name is stored as an offset and a length into the (memory-mapped)
+    Newick buffer and is only decoded when it is accessed.
+    '''
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            start = self.offset[idx]
+            return bytes(self.buf[start:start + self.length[idx]]).decode()
+        return self.decode(idx)
+
+    def decode(self, idx=slice(None)):
+        '''
+        Decodes the names (or a selection of them) into an object array.
+        '''
+
+        start = self.offset[idx]
+        blob = gather_ranges(self.buf, start, start + self.length[idx], 0)
+        names = np.empty(len(start), dtype=object)
+        names[:] = blob.decode().split('\x00')[:-1]
+        return names
+
+
+def strip_ranges(buf, start, stop):
+    '''
+    Removes the leading and trailing whitespace from the byte ranges
+    `buf[start:stop]` (in place).
+    '''
+
+    active = np.nonzero(stop > start)[0]
+    while len(active) > 0:
+        active = active[buf[start[active]] <= ord(' ')]
+        start[active] += 1
+        active = active[stop[active] > start[active]]
+
+    active = np.nonzero(stop > start)[0]
+    while len(active) > 0:
+        active = active[buf[stop[active] - 1] <= ord(' ')]
+        stop[active] -= 1
+        active = active[stop[active] > start[active]]
+
+
+def parse_buffer(buf):
+    '''
+    Parses a Newick tree stored in a uint8 buffer into preorder `parent`,
+    `names` and `length` arrays.
+
+    Every node is opened by a '(' or ',' (the root by the start of the
+    buffer), so the node ids follow directly from the order of those
+    characters.  The parent of a node, and the branch closed by a ')', is
+    the last node opened one nesting level further out, which is found for
+    all nodes at once by a search over the nodes sorted by depth.  Names
+    are returned as a `NewickNames` table pointing into `buf`.  Missing
+    branch lengths are stored as NaN.
+    '''
+
+    pos, kind = scan_events(buf)
+
+    # a virtual ',' opens the root
+    pos = np.concatenate([[-1], pos])
+    kind = np.concatenate([[COMMA], kind])
+
+    depth = np.cumsum(kind == OPEN, dtype=np.int32)
+    depth -= np.cumsum(kind == CLOSE, dtype=np.int32)
+
+    is_open = (kind == OPEN) | (kind == COMMA)
+    node_event = np.nonzero(is_open)[0]
+    nnodes = len(node_event)
+
+    # nodes sorted by depth and, within each depth, by position
+    order = np.argsort(depth[node_event], kind='stable')
+    scale = len(buf) + 2
+    keys = depth[node_event][order].astype(np.int64) * scale + pos[node_event][order]
+
+    def last_opened(level, before):
+        return order[np.searchsorted(keys, level.astype(np.int64) * scale + before) - 1]
+
+    parent = np.full(nnodes, -1, dtype=int)
+    parent[1:] = last_opened(depth[node_event[1:]] - 1, pos[node_event[1:]])
+
+    # the label of a leaf follows its opening character, the label of a
+    # branch follows its closing ')'
+    label_event = np.nonzero((is_open[:-1] & (kind[1:] != OPEN)) |
+                             (kind[:-1] == CLOSE))[0]
+
+    owner = np.empty(len(label_event), dtype=int)
+    opened = is_open[label_event]
+    owner[opened] = np.searchsorted(node_event, label_event[opened])
+    closed = label_event[~opened]
+    owner[~opened] = last_opened(depth[closed], pos[closed])
+
+    name_start = pos[label_event] + 1
+    name_stop = pos[label_event + 1]
+    strip_ranges(buf, name_start, name_stop)
+
+    name_offset = np.zeros(nnodes, dtype=np.int64)
+    name_length = np.zeros(nnodes, dtype=np.int32)
+    name_offset[owner] = name_start
+    name_length[owner] = name_stop - name_start
+
+    length = np.full(nnodes, np.nan)
+
+    has_length = kind[label_event + 1] == COLON
+    colon = label_event[has_length] + 1
+    length_start = pos[colon] + 1
+    length_stop = pos[colon + 1]
+    strip_ranges(buf, length_start, length_stop)
+
+    # all the branch lengths are converted by a single call to numpy
+    keep = length_stop > length_start
+    if np.any(keep):
+        blob = gather_ranges(buf, length_start[keep], length_stop[keep], ord(' '))
+        values = np.fromstring(blob.decode(), sep=' ')
+        if len(values) != np.sum(keep):
+            raise ValueError("Could not read all the branch lengths")
+        length[owner[has_length][keep]] = values
+
+    return parent, NewickNames(buf, name_offset, name_length), length
+
+
+def parse(newick):
+    '''
+    Parses a Newick string into preorder `parent`, `names` and `length` arrays.
+    '''
+
+    buf = np.frombuffer(newick.encode(), dtype=np.uint8)
+    parent, names, length = parse_buffer(buf)
+
+    return parent, names.decode(), length
+
+
+def index_newick(file_name, chunk_size=2 ** 24):
+    '''
+    Finds the byte range and the number of nodes of every tree in a Newick file.
+
+    Trees may span several lines and are terminated by ';'.  The file is
+    scanned once in chunks, so the memory use does not depend on the file
+    size.  Returns a list of (start, end, nnodes) tuples.
+    '''
+
+    trees = []
+
+    start = 0
+    ndelims = 0
+    pending = False
+    offset = 0
+
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+
+            buf = np.frombuffer(chunk, dtype=np.uint8)
+            ends = np.nonzero(buf == ord(';'))[0]
+            delims = np.nonzero((buf == ord('(')) | (buf == ord(',')))[0]
+            # number of '(' and ',' in front of each ';' within this chunk
+            ncum = np.searchsorted(delims, ends)
+
+            for end, n in zip(ends, np.diff(ncum, prepend=0)):
+                trees.append((start, offset + int(end) + 1, ndelims + int(n) + 1))
+                start = offset + int(end) + 1
+                ndelims = 0
+
+            if len(ends) > 0:
+                delims = delims[ncum[-1]:]
+                buf = buf[ends[-1] + 1:]
+                pending = False
+
+            # anything but whitespace after the last ';' starts a new tree
+            ndelims += len(delims)
+            pending = pending or bool(np.any(buf > ord(' ')))
+            offset += len(chunk)
+
+    # a last tree without the closing ';'
+    if pending:
+        trees.append((start, offset, ndelims + 1))
+
+    return trees
+
+
+def newick_arrays(buf):
+    '''
+    Parses a Newick tree stored in a uint8 buffer into the components of
+    the tree data.
+    '''
+
+    parent, names, size = parse_buffer(buf)
+
+    if np.isnan(size[0]):
+        size[0] = 0
+
+    return {'parent': parent,
+            'names': names,
+            'size': size,
+            'height': compute_heights(parent, size)}